@@ -3,7 +3,7 @@ from logic.models import RoomModel
 
 
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ["id", "name"]
+    list_display = ["id", "name", "owner", "lease_expires"]
     search_fields = ["name"]
 
 
@@ -1,6 +1,5 @@
 from django.apps import AppConfig
 import json
-import sys
 
 
 def import_current_word_list():
@@ -37,9 +36,10 @@ class LogicConfig(AppConfig):
     verbose_name = "logic"
 
     def ready(self):
-        # Must migrate to update the database, ignore if testing via 'pytest'
-        if "migrate" in sys.argv or "pytest" in sys.modules:
-            return
-        else:
-            clean_rooms()
-            import_current_word_list()
+        # Connect the word lists cache invalidation, room store and SQLite signals
+        from logic.utils import room_store, sqlite_profile, word_lists
+
+        # Nothing is read or written here: this runs in every process importing Django
+        # (workers, management commands...). The database is prepared once per deploy
+        # with 'python manage.py bootstrap' and every worker warms up on start (see
+        # 'logic.utils.lifecycle')
@@ -0,0 +1,15 @@
+import asyncio
+
+import pytest
+
+
+# Every async test and fixture runs on one event loop, as the server does, so the
+# process-wide state (room store connections, write-behind queue, timers...) is kept
+# between tests instead of belonging to a loop that is already closed.
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
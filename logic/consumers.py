@@ -1,36 +1,36 @@
-import json
-
+from channels.consumer import AsyncConsumer
+from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
-from .utils.consumer_classes import State, WebsocketUser
-from .utils import sync_rest_calls, consumer_methods
+from .utils import (
+    actions,
+    consumer_methods,
+    lifecycle,
+    room_state,
+    sharding,
+    turns,
+    voting,
+    wire,
+)
+from .utils.heartbeat import heartbeat
 
 
+@actions.register
 class RoomConsumer(AsyncJsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(args, kwargs)
         self.room_name = None
         self.room_group_name = None
+        self.room = None
         self.user = None
-        self.selected_word = None
-        self.votes = []
-        self.filtered_players = []
-        self.word_list = []
-        self.outsiders = []
-        self.repeated_words = None
-        self.first_player = None
         self.finish_game = False
 
-        self.possible_actions = [
-            "default",
-            "connection",
-            "startGame",
-            "nextTurn",
-            "votingOutsider",
-            "lastChance",
-            "nextRound",
-            "endGame",
-        ]
+        # Clients joining with "roster": "delta" receive roster changes instead of
+        # the whole roster on every message
+        self.roster_mode = "snapshot"
+
+        # Clients negotiating 'wire.BINARY_SUBPROTOCOL' exchange MessagePack frames
+        self.binary = False
 
     # region Websocket methods
 
@@ -38,48 +38,63 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"room_{self.room_name}"
 
+        # The worker is shutting down (the client will reconnect to another one)
+        if lifecycle.draining:
+            await self.close()
+            return
+
         try:
-            self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
-            if self.db_room.started_game == True:
-                await self.close()
+            room = await room_state.get_room(room_name=self.room_name)
         except:
             await self.close()
             return "Error - Cannot access a room that does not exist"
 
+        if room.started_game == True:
+            room_state.release_room(room)
+            await self.close()
+            return
+
+        self.room = room
+        self.room.sockets += 1
+
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        if wire.BINARY_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            self.binary = True
+            self.room.binary_clients += 1
+            await self.accept(subprotocol=wire.BINARY_SUBPROTOCOL)
+        else:
+            await self.accept()
 
     async def disconnect(self, close_code):
-        if self.finish_game:
-            return
+        heartbeat.unwatch(self)
 
-        try:
-            self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
-        except:
+        if not self.room:
             await self.close()
             return "Error - Cannot access a room that does not exist"
 
-        if self.user and self.db_room.current_connections:
-            for player in self.db_room.current_connections:
-                if player["id"] == self.user.id:
-                    self.db_room.current_connections.remove(player)
-                    break
+        self.room.sockets -= 1
+        if self.binary:
+            self.room.binary_clients -= 1
 
-            if self.db_room.current_connections:
-                if self.user.captain:
-                    for player in self.db_room.current_connections:
-                        if player["state"] != State.OUT:
-                            player["captain"] = True
-                            break
+        # Leave room group (also after 'endGame', the local groups never expire)
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+        if self.finish_game:
+            return
 
-                if self.user.outsider:
-                    self.db_room.number_outsiders -= 1
+        if self.user and self.room.current_connections:
+            await room_state.leave_room(self.room, self.user)
 
-                await sync_rest_calls.update_room(self.db_room)
+            if self.room.current_connections:
+                await room_state.save_room(self.room)
+                await voting.remove_voter(self.room, self.user.id)
             else:
                 # Delete current room if there's no users left
-                await sync_rest_calls.delete_room(room_name=self.room_name)
+                try:
+                    await room_state.delete_room(room_name=self.room_name)
+                except:
+                    pass
 
             # Send "disconnection" message to room group
             await self.channel_layer.group_send(
@@ -87,154 +102,269 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
                 {
                     "type": "disconnection",
                     "message": self.user.username + " se ha desconectado",
-                    "disconnected_user": self.user.__dict__,
+                    "disconnected_user": self.user.to_dict(),
+                    **wire.roster_event(self.room),
                 },
             )
 
-        # Leave room group
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            # A player leaving in its turn passes it to the next one
+            await turns.pass_turn(self.room, self.user)
 
-    async def receive_json(self, content):
-        if not "message" in content:
+        # Sockets that never joined a player keep the room in memory until they leave
+        room_state.release_room(self.room)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary:
+            try:
+                content = wire.unpack(bytes_data)
+            except Exception:
+                return
+            await self.receive_json(content)
             return
+        await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
 
-        message = content["message"]
+    async def receive_json(self, content):
+        # Any message shows the client is alive (e.g. {"action": "pong"})
+        heartbeat.touch(self)
 
-        username = ""
-        if "username" in content:
-            username = content["username"]
+        if not isinstance(content, dict):
+            return
 
-        action = "default"
+        name = content.get("action", "default")
+        if not isinstance(name, str):
+            return
 
-        # Check action to take
-        if "action" in content:
-            action = content["action"]
+        action = self.actions.get(name)
+        if action is None or not action.valid(content) or not action.allowed(self):
+            return
 
-            if action not in self.possible_actions:
-                return
+        await action.handler(self, content)
 
-            # Check connections to add the new player
-            if action == "connection":
-                captain = True if len(self.db_room.current_connections) == 0 else False
-                self.user = WebsocketUser(username=username, captain=captain)
-                self.db_room.current_connections.append(self.user.__dict__)
-                await sync_rest_calls.update_room(self.db_room)
-
-            # Start game by selecting the posibles 'outsiders', shuffling the players and selecting a word
-            elif action == "startGame":
-                start_game = await consumer_methods.startGameLogic(self, restart=False)
-
-                if not start_game:
-                    action = "endGame"
-                    try:
-                        await sync_rest_calls.delete_room(room_name=self.room_name)
-                    except:
-                        pass
-
-                if action == "startGame":
-                    self = start_game
-
-                    message = {
-                        "outsiders": self.outsiders,
-                        "selected_word": self.selected_word,
-                        "first_player": self.first_player,
-                        "turn_order": self.db_room.current_connections,
-                    }
-
-            # Add guessWord and pass the turn to the next player
-            elif action == "nextTurn":
-                self.user.guessWord = message
-                self.user.state = State.PLAYING
-
-                players = content["order"]
-                for i in range(len(players)):
-                    if players[i]["state"] == State.OUT:
-                        continue
-                    if players[i]["id"] == self.user.id:
-                        players[i]["guessWord"] = message
-                        if (i + 1) < len(players):
-                            players[i + 1]["state"] = State.PLAYER_TURN
-                            next_player = players[i + 1]["id"]
-                        else:
-                            next_player = players[0]
-
-                message = {"turn_order": players, "next_player": next_player}
-
-            # Add one vote to the selected player
-            elif action == "votingOutsider":
-                message = {
-                    "player_vote": message,
-                }
-
-            # Check if the Ousider guessed correctly the password
-            elif action == "lastChance":
-                guess = message.casefold()
-                key_word = self.selected_word["a"].casefold()
-
-                message = {
-                    "last_chance_guess": guess == key_word,
-                }
-
-            # "Restart" the game state with a new word and turn order
-            elif action == "nextRound":
-                self = await consumer_methods.startGameLogic(self, restart=True)
-
-                message = {
-                    "outsiders": self.outsiders,
-                    "selected_word": self.selected_word,
-                    "first_player": self.first_player,
-                    "turn_order": self.db_room.current_connections,
-                }
-
-            # End the current game for all the users/connections
-            elif action == "endGame":
-                try:
-                    await sync_rest_calls.delete_room(room_name=self.room_name)
-                except:
-                    pass
+    async def broadcast(self, action, content, message, roster=None):
+        event = {
+            "type": action,
+            "message": message,
+            "username": content.get("username", ""),
+        }
+        if roster is not None:
+            event.update(roster)
 
         # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {"type": action, "message": message, "username": username},
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=wire.pack(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+    async def send_prepared(self, content, prepared):
+        # The prepared values are already encoded for this client (see 'encode_user')
+        if self.binary:
+            await self.send(bytes_data=wire.packed_frame(content, prepared))
+        else:
+            await self.send(text_data=wire.frame(content, prepared))
+
+    def encode_user(self, user):
+        if self.binary:
+            return wire.pack(user if user else "")
+        return wire.encode_nested(user) if user else '""'
+
+    def encode_roster(self):
+        if self.binary:
+            return wire.packed_roster(self.room.current_connections)
+        return wire.roster_array(self.room.current_connections)
+
+    async def send_with_roster(self, event, content, prepared, snapshot=False):
+        if self.binary:
+            await self.send_packed_roster(event, content, prepared, snapshot)
+            return
+
+        if self.roster_mode == "delta":
+            content["roster_seq"] = event["roster_seq"]
+            if snapshot:
+                prepared["roster"] = self.encode_roster()
+            else:
+                prepared["roster_delta"] = event["roster_delta"]
+        else:
+            prepared["actual_users"] = event["actual_users"]
+
+        await self.send_prepared(content, prepared)
+
+    async def send_packed_roster(self, event, content, prepared, snapshot):
+        # The packed roster fields are only in the events of rooms that had binary
+        # clients when they were sent, otherwise the roster is packed here
+        if self.roster_mode == "delta":
+            content["roster_seq"] = event["roster_seq"]
+            if snapshot or "packed_delta" not in event:
+                prepared["roster"] = self.encode_roster()
+            else:
+                prepared["roster_delta"] = event["packed_delta"]
+        elif "packed_users" in event:
+            prepared["actual_users"] = event["packed_users"]
+        else:
+            prepared["actual_users"] = self.encode_roster()
+
+        await self.send_prepared(content, prepared)
+
+    # endregion
+
+    # region Actions (see 'utils.actions')
+
+    @actions.action("default")
+    async def defaultAction(self, content):
+        await self.broadcast("default", content, content["message"])
+
+    # Check connections to add the new player
+    @actions.action(
+        "connection",
+        optional={"username": str, "roster": str, "heartbeat": bool},
+        role=actions.GUEST,
+        phases=[actions.LOBBY],
+    )
+    async def connectionAction(self, content):
+        if content.get("roster") == "delta":
+            self.roster_mode = "delta"
+        # Clients answering pings are evicted when they stop answering
+        if content.get("heartbeat") == True:
+            heartbeat.watch(self)
+
+        self.user = await room_state.join_room(
+            self.room, content.get("username", ""), self.channel_name
         )
+        await room_state.save_room(self.room)
+
+        # Roster encoded once for every recipient of the room group
+        await self.broadcast(
+            "connection",
+            content,
+            {"user_id": self.user.id},
+            roster=wire.roster_event(self.room),
+        )
+
+    # Start game by selecting the posibles 'outsiders', shuffling the players and selecting a word
+    @actions.action("startGame", role=actions.CAPTAIN, phases=[actions.LOBBY])
+    async def startGameAction(self, content):
+        if await consumer_methods.startGameLogic(self.room, restart=False):
+            # Every player gets its own view of the round
+            await consumer_methods.sendRoundViews(self.room, "startGame")
+            return
+
+        try:
+            await room_state.delete_room(room_name=self.room_name)
+        except:
+            pass
+        await self.broadcast("endGame", content, content["message"])
+
+    # Add guessWord and pass the turn to the next player (only the player with the turn
+    # can end it, the order is the room's)
+    @actions.action(
+        "nextTurn", schema={"message": str}, role=actions.TURN, phases=[actions.GAME]
+    )
+    async def nextTurnAction(self, content):
+        next_player = self.room.next_turn(self.user, guess_word=content["message"])
+        await room_state.save_room(self.room)
+        turns.start_turn(self.room, next_player)
+
+        await self.broadcast(
+            "nextTurn",
+            content,
+            {"next_player": next_player.id if next_player else ""},
+            roster=wire.roster_event(self.room),
+        )
+
+    # Add one vote to the selected player, only the result is sent to the room group
+    @actions.action(
+        "votingOutsider",
+        schema={"message": str},
+        role=actions.PLAYER,
+        phases=[actions.GAME],
+    )
+    async def votingOutsiderAction(self, content):
+        await voting.cast_vote(self.room, self.user.id, content["message"])
+
+    # Check if the Ousider guessed correctly the password
+    @actions.action(
+        "lastChance",
+        schema={"message": str},
+        role=actions.PLAYER,
+        phases=[actions.GAME],
+    )
+    async def lastChanceAction(self, content):
+        guess = content["message"].casefold()
+        key_word = self.room.selected_word["a"].casefold()
+
+        await self.broadcast(
+            "lastChance", content, {"last_chance_guess": guess == key_word}
+        )
+
+    # "Restart" the game state with a new word and turn order
+    @actions.action("nextRound", role=actions.CAPTAIN, phases=[actions.GAME])
+    async def nextRoundAction(self, content):
+        if await consumer_methods.startGameLogic(self.room, restart=True):
+            await consumer_methods.sendRoundViews(self.room, "nextRound")
+
+    # Send the whole roster again, when the client detects a gap in 'roster_seq'
+    @actions.action("resync")
+    async def resyncAction(self, content):
+        await self.send_prepared(
+            content={
+                "message_type": "roster",
+                "roster_seq": self.room.roster_seq,
+            },
+            prepared={"roster": self.encode_roster()},
+        )
+
+    # End the current game for all the users/connections
+    @actions.action("endGame", role=actions.PLAYER)
+    async def endGameAction(self, content):
+        try:
+            await room_state.delete_room(room_name=self.room_name)
+        except:
+            pass
+        await self.broadcast("endGame", content, content["message"])
 
     # endregion
 
     # region Room group methods
 
     async def connection(self, event):
-        self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
-        await self.updateConnections(type="connection", username=event["username"])
+        await self.updateConnections(
+            type="connection",
+            username=event["username"],
+            event=event,
+            # A joining player starts from the whole roster
+            snapshot=self.user is not None
+            and event["message"]["user_id"] == self.user.id,
+        )
 
     async def disconnection(self, event):
-        self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
         disconnected_user = event["disconnected_user"]
 
-        if disconnected_user["captain"] == True:
-            if self.db_room.current_connections[0]["id"] == self.user.id:
-                self.user.captain = True
-
         await self.updateConnections(
             type="disconnection",
             username=disconnected_user["username"],
+            event=event,
             disconnected_user=disconnected_user,
         )
 
-    async def updateConnections(self, type, username, disconnected_user=None):
+    async def updateConnections(
+        self, type, username, event, disconnected_user=None, snapshot=False
+    ):
         ms = "Se ha unido a la sala" if type == "connection" else "Se ha desconectado"
 
-        await self.send_json(
+        await self.send_with_roster(
+            event,
             content={
                 "message_type": type,
                 "message": ms,
                 "username": username,
-                "user": json.dumps(self.user.__dict__) if self.user else "",
-                "actual_users": json.dumps(
-                    self.db_room.current_connections, default=lambda x: x.__dict__
-                ),
                 "disconnected_user": disconnected_user,
-            }
+            },
+            prepared={
+                "user": self.encode_user(self.user),
+            },
+            snapshot=snapshot,
         )
 
     async def default(self, event):
@@ -247,94 +377,48 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             }
         )
 
-    async def startGame(self, event):
-        self.outsiders = event["message"]["outsiders"]
-
-        self, key_word, turn_order = await consumer_methods.startGameLogicRoomGroup(
-            self=self, event=event
-        )
-
-        await self.send_json(
+    async def roundStart(self, event):
+        # 'startGame' or 'nextRound', prepared for this player by the room
+        await self.send_with_roster(
+            event,
             content={
-                "message_type": "startGame",
-                "user": json.dumps(self.user.__dict__),
-                "key_word": key_word,
-                "actual_users": json.dumps(turn_order, default=lambda x: x.__dict__),
-            }
+                "message_type": event["message_type"],
+                "key_word": event["key_word"],
+            },
+            prepared={
+                # Prepared by the room for the JSON clients
+                "user": self.encode_user(self.user) if self.binary else event["user"],
+            },
         )
 
-        self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
-
     async def nextTurn(self, event):
-        if event["message"]["next_player"] == self.user.id:
-            self.user.state = State.PLAYER_TURN
-
-        await self.send_json(
+        # The room already gave the turn to the next player
+        await self.send_with_roster(
+            event,
             content={
                 "message_type": "nextTurn",
-                "user": json.dumps(self.user.__dict__),
-                "actual_users": json.dumps(
-                    event["message"]["turn_order"], default=lambda x: x.__dict__
-                ),
-            }
-        )
-
-    async def votingOutsider(self, event):
-        # ONLY THE CAPTAIN COUNT THE VOTES
-        if not self.user.captain:
-            return
-
-        self, continue_voting, player_out, can_continue, next_captain = (
-            await consumer_methods.votingOutsider(
-                self=self, player_vote=event["message"]["player_vote"]
-            )
-        )
-
-        # Keep counting ALL the votes...
-        if continue_voting:
-            return
-
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "votingComplete",
-                "player_out": player_out,
-                "continue_playing": can_continue,
-                "number_outsiders": self.db_room.number_outsiders,
-                "next_captain": next_captain,
-                "actual_users": json.dumps(
-                    self.db_room.current_connections, default=lambda x: x.__dict__
-                ),
+            },
+            prepared={
+                "user": self.encode_user(self.user),
             },
         )
 
-        await sync_rest_calls.update_room(self.db_room)
-
     async def votingComplete(self, event):
+        # The room already updated the eliminated player and the new captain
         player_out = event["player_out"]
-        next_captain = event["next_captain"]
         continue_playing = event["continue_playing"]
-        actual_users = event["actual_users"]
-
-        if player_out:
-            if player_out["id"] == self.user.id:
-                self.user.state = State.OUT
-                if self.user.captain == True:
-                    self.user.captain = False
 
-            elif next_captain and next_captain["id"] == self.user.id:
-                self.user.captain = True
-
-        await self.send_json(
+        await self.send_with_roster(
+            event,
             content={
                 "message_type": "votingComplete",
-                "user": json.dumps(self.user.__dict__),
                 "player_out": player_out,
                 "continue_playing": continue_playing,
                 "number_outsiders": event["number_outsiders"],
-                "actual_users": json.dumps(actual_users, default=lambda x: x.__dict__),
-            }
+            },
+            prepared={
+                "user": self.encode_user(self.user),
+            },
         )
 
     async def lastChance(self, event):
@@ -345,20 +429,6 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
             }
         )
 
-    async def nextRound(self, event):
-        self, key_word, turn_order = await consumer_methods.startGameLogicRoomGroup(
-            self=self, event=event
-        )
-
-        await self.send_json(
-            content={
-                "message_type": "nextRound",
-                "user": json.dumps(self.user.__dict__),
-                "key_word": key_word,
-                "actual_users": json.dumps(turn_order, default=lambda x: x.__dict__),
-            }
-        )
-
     async def endGame(self, event):
         self.finish_game = True
         await self.send_json(
@@ -368,3 +438,30 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         )
 
     # endregion
+
+
+class RoomRelayConsumer(AsyncConsumer):
+    # Websocket of a room owned by another worker (see 'utils.sharding')
+
+    async def websocket_connect(self, message):
+        room_name = self.scope["url_route"]["kwargs"]["room_name"]
+        self.owner = sharding.shard_channel(sharding.shard_for(room_name))
+
+        await self.forward(
+            {"type": "shard.open", "scope": sharding.forward_scope(self.scope)}
+        )
+
+    async def websocket_receive(self, message):
+        await self.forward({"type": "shard.receive", "message": message})
+
+    async def websocket_disconnect(self, message):
+        await self.forward({"type": "shard.receive", "message": message})
+        raise StopConsumer()
+
+    async def relay_send(self, event):
+        # 'websocket.accept', 'websocket.send' or 'websocket.close' from the owner
+        await self.send(event["message"])
+
+    async def forward(self, message):
+        message["relay"] = self.channel_name
+        await self.channel_layer.send(self.owner, message)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from logic.apps import clean_rooms, import_current_word_list
+
+
+# One-shot preparation of the database, once per deploy after the migrations and
+# before starting the workers:
+#
+#   python manage.py migrate && python manage.py bootstrap
+#
+# Loads the 'Current' word list when it's empty. '--clean-rooms' deletes every room,
+# only for when no worker is running (e.g. building the image). Otherwise the rooms
+# left with players by a previous worker are reclaimed by their owner when used (see
+# 'room_state.reclaim_room') or deleted once their lease expires (see 'leases').
+
+
+class Command(BaseCommand):
+    help = "Prepare the database once per deploy (word list and, optionally, rooms)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clean-rooms",
+            action="store_true",
+            help="Delete every room, no worker must be running",
+        )
+
+    def handle(self, *args, **options):
+        import_current_word_list()
+        if options["clean_rooms"]:
+            clean_rooms()
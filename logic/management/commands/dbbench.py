@@ -0,0 +1,156 @@
+import json
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from logic.management.commands.loadtest import percentile, temporary_database
+from logic.models import RoomModel
+from logic.utils.consumer_classes import WebsocketUser
+from logic.utils.sqlite_profile import PROFILES
+
+
+# Read/write throughput of the rooms table with concurrent rooms for each SQLite
+# profile (see 'logic.utils.sqlite_profile'). Every room has a thread updating its
+# players, as the write-behind queue does, while reader threads load random rooms, as
+# the consumers joining a room do.
+#
+#   python manage.py dbbench --rooms 16 --readers 8 --seconds 5
+#
+# Each profile runs on its own temporary database file (see 'temporary_database' in
+# 'loadtest'), the local database is not touched.
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self.read_latencies = []
+
+    def add(self, field, latency=None):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+            if latency is not None:
+                self.read_latencies.append(latency)
+
+
+def room_players(count):
+    return [
+        WebsocketUser(username=f"Player{index}", captain=index == 0).to_dict()
+        for index in range(count)
+    ]
+
+
+def writer(room_name, players, stop, counter):
+    try:
+        while not stop.is_set():
+            random.shuffle(players)
+            try:
+                RoomModel.objects.filter(name=room_name).update(
+                    current_connections=players
+                )
+                counter.add("writes")
+            except Exception:
+                counter.add("errors")
+    finally:
+        connection.close()
+
+
+def reader(room_names, stop, counter):
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                RoomModel.objects.get(name=random.choice(room_names))
+                counter.add("reads", time.perf_counter() - start)
+            except Exception:
+                counter.add("errors")
+    finally:
+        connection.close()
+
+
+def run_benchmark(options):
+    room_names = [f"dbbench_{index}" for index in range(options["rooms"])]
+    RoomModel.objects.bulk_create(
+        RoomModel(name=name, current_connections=room_players(options["players"]))
+        for name in room_names
+    )
+    connection.close()
+
+    counter = Counter()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=writer, args=(name, room_players(options["players"]), stop, counter)
+        )
+        for name in room_names
+    ]
+    threads += [
+        threading.Thread(target=reader, args=(room_names, stop, counter))
+        for _ in range(options["readers"])
+    ]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(options["seconds"])
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "reads_per_s": round(counter.reads / options["seconds"], 1),
+        "writes_per_s": round(counter.writes / options["seconds"], 1),
+        "errors": counter.errors,
+        "read_p50_ms": round(percentile(counter.read_latencies, 0.5) * 1000, 3),
+        "read_p99_ms": round(percentile(counter.read_latencies, 0.99) * 1000, 3),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare the rooms table read/write throughput of the SQLite profiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=16)
+        parser.add_argument("--players", type=int, default=6)
+        parser.add_argument("--readers", type=int, default=8)
+        parser.add_argument("--seconds", type=float, default=5)
+        parser.add_argument(
+            "--profile", choices=list(PROFILES), action="append", dest="profiles"
+        )
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            self.stderr.write("The SQLite profiles need DATABASE=sqlite")
+            return
+
+        report = {}
+        for profile in options["profiles"] or ["rollback", "wal"]:
+            report[profile] = self.run_profile(profile, options)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+
+        self.stdout.write(
+            f"{options['rooms']} rooms writing, {options['readers']} readers, "
+            f"{options['seconds']} s"
+        )
+        for profile, result in report.items():
+            self.stdout.write(
+                f"  {profile:<10} reads {result['reads_per_s']:>10}/s  "
+                f"writes {result['writes_per_s']:>8}/s  "
+                f"read p50 {result['read_p50_ms']:>7} ms  "
+                f"p99 {result['read_p99_ms']:>7} ms  "
+                f"errors {result['errors']}"
+            )
+
+    def run_profile(self, profile, options):
+        with override_settings(SQLITE_PROFILE=profile):
+            with temporary_database(f"outsider_dbbench_{profile}.sqlite3"):
+                return run_benchmark(options)
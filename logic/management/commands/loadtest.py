@@ -0,0 +1,353 @@
+import asyncio
+import contextlib
+import json
+import random
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from logic.routing import websocket_urlpatterns
+from logic.utils import sync_rest_calls
+from logic.utils.consumer_classes import State
+from logic.utils.db_executor import executor
+
+
+# Load test of the room websockets. Every room is played by bot players through
+# 'RoomConsumer' (connection, startGame, nextTurn, votingOutsider, lastChance,
+# nextRound, endGame) and the time from an action to its broadcast is measured
+# on every player of the room.
+#
+#   python manage.py loadtest --rooms 1000 --players 6 --rounds 3 --think 0.5
+#
+# Runs on a test database (see 'temporary_database'), the local database is not
+# touched. The
+# channel layer is chosen with '--layer' (see CHANNEL_LAYER in the settings), 'memory'
+# is the Channels in-memory layer, which looks for expired messages on every receive.
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.actions = 0
+        self.messages = 0
+        self.rooms = 0
+        self.errors = 0
+
+    def add(self, action, latencies):
+        self.actions += 1
+        self.messages += len(latencies)
+        self.latencies.setdefault(action, []).extend(latencies)
+
+    def all_latencies(self):
+        return [latency for values in self.latencies.values() for latency in values]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+@contextlib.contextmanager
+def temporary_database(name):
+    # Test database of the benchmarks. With SQLite it's a temporary file and the default
+    # database points to it until it's destroyed, so no connection of the command (async
+    # ORM, DB executor threads...) opens the local file, which would get the pragmas of
+    # SQLITE_PROFILE (e.g. the write-ahead log)
+    settings_dict = connection.settings_dict
+    local_name = settings_dict["NAME"]
+    if connection.vendor == "sqlite":
+        # The in-memory test database fails on table locks instead of waiting when
+        # it's used from several threads (async ORM and DB executor), a file doesn't
+        connection.close()
+        path = os.path.join(tempfile.gettempdir(), name)
+        settings_dict["NAME"] = settings_dict["TEST"]["NAME"] = path
+
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False
+    )
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        settings_dict["NAME"] = local_name
+
+
+class Bot:
+    def __init__(self, application, room_name, username, timeout):
+        self.username = username
+        self.timeout = timeout
+        self.user = None
+        self.last = None
+        self.communicator = WebsocketCommunicator(
+            application=application, path=f"ws/room/{room_name}/"
+        )
+
+    @property
+    def active(self):
+        return self.user is not None and self.user["state"] != State.OUT
+
+    async def connect(self):
+        connected, subprotocol = await self.communicator.connect(timeout=self.timeout)
+        if not connected:
+            raise Exception(f"{self.username} cannot connect")
+
+    async def send(self, action, message="", **content):
+        await self.communicator.send_json_to(
+            {"action": action, "message": message, "username": self.username, **content}
+        )
+
+    async def expect(self, message_type):
+        # Other messages (e.g. of previous actions) are skipped
+        while True:
+            message = await self.communicator.receive_json_from(timeout=self.timeout)
+            received = time.perf_counter()
+
+            if "user" in message and message["user"]:
+                self.user = json.loads(message["user"])
+
+            if message["message_type"] == message_type:
+                self.last = message
+                return received
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+class RoomBots:
+    def __init__(self, application, index, options, stats):
+        self.name = f"loadtest_{index}"
+        self.options = options
+        self.stats = stats
+        self.bots = [
+            Bot(application, self.name, f"Bot{i}", options["timeout"])
+            for i in range(options["players"])
+        ]
+
+    async def think(self):
+        if self.options["think"] > 0:
+            await asyncio.sleep(random.uniform(0, 2 * self.options["think"]))
+
+    async def broadcast(self, action, sender, message_type=None, message="", **content):
+        # Latency from the action until every player of the room receives it
+        receivers = [bot for bot in self.bots if bot.user or bot is sender]
+        start = time.perf_counter()
+        await sender.send(action, message, **content)
+        received = await asyncio.gather(
+            *(bot.expect(message_type or action) for bot in receivers)
+        )
+        self.stats.add(action, [moment - start for moment in received])
+
+    def leader(self):
+        # The rounds are started by the captain
+        return next(bot for bot in self.bots if bot.user and bot.user["captain"])
+
+    async def play(self):
+        await sync_rest_calls.create_room(room_name=self.name)
+
+        for bot in self.bots:
+            await self.think()
+            await bot.connect()
+            await self.broadcast("connection", bot)
+
+        for round in range(self.options["rounds"]):
+            await self.think()
+            action = "startGame" if round == 0 else "nextRound"
+            await self.broadcast(action, self.leader())
+
+            # Every active player gives a word in its turn
+            for _ in [bot for bot in self.bots if bot.active]:
+                turn = next(
+                    (
+                        bot
+                        for bot in self.bots
+                        if bot.user and bot.user["state"] == State.PLAYER_TURN
+                    ),
+                    None,
+                )
+                if turn is None:
+                    break
+
+                await self.think()
+                await self.broadcast("nextTurn", turn, message=f"word_{round}")
+
+            # Every active player votes the same player, the last ballot closes it
+            voters = [bot for bot in self.bots if bot.active]
+            voted = random.choice(voters).user["id"]
+            for voter in voters[:-1]:
+                await self.think()
+                await voter.send("votingOutsider", voted)
+
+            await self.think()
+            await self.broadcast(
+                "votingOutsider", voters[-1], "votingComplete", message=voted
+            )
+
+            result = self.bots[0].last
+            if not result["continue_playing"]:
+                if result["player_out"] and result["player_out"]["outsider"]:
+                    await self.broadcast(
+                        "lastChance", self.leader(), "lastChanceGuess", message="?"
+                    )
+                break
+
+        await self.think()
+        await self.broadcast("endGame", self.leader())
+
+    async def run(self):
+        try:
+            await self.play()
+            self.stats.rooms += 1
+        except Exception as e:
+            self.stats.errors += 1
+            print(f"EXCEPTION -> Load test room '{self.name}' failed.")
+            print(repr(e))
+        finally:
+            for bot in self.bots:
+                await bot.disconnect()
+
+
+async def run_load_test(options):
+    await sync_rest_calls.set_word_list()
+
+    application = URLRouter(websocket_urlpatterns)
+    stats = Stats()
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            RoomBots(application, index, options, stats).run()
+            for index in range(options["rooms"])
+        )
+    )
+    stats.elapsed = time.perf_counter() - start
+
+    return stats
+
+
+class Command(BaseCommand):
+    help = "Play concurrent rooms with bot players and report latency and throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--players", type=int, default=4)
+        parser.add_argument("--rounds", type=int, default=3)
+        parser.add_argument(
+            "--think", type=float, default=0.0, help="Mean think time (seconds)"
+        )
+        parser.add_argument(
+            "--layer", choices=["local", "hybrid", "redis", "memory"], default="local"
+        )
+        parser.add_argument("--redis", default="localhost:6379")
+        parser.add_argument("--timeout", type=float, default=30)
+        parser.add_argument(
+            "--tracemalloc", action="store_true", help="Report Python heap peak"
+        )
+        parser.add_argument("--json", action="store_true")
+
+    def channel_layers(self, options):
+        if options["layer"] == "memory":
+            return {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+        host, port = options["redis"].split(":")
+        hosts = [(host, int(port))]
+
+        if options["layer"] == "redis":
+            return {
+                "default": {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": hosts},
+                }
+            }
+
+        return {
+            "default": {
+                "BACKEND": "logic.utils.channel_layer.HybridChannelLayer",
+                "CONFIG": {
+                    "hosts": hosts if options["layer"] == "hybrid" else [],
+                    "local_groups": ["room_"],
+                },
+            }
+        }
+
+    def handle(self, *args, **options):
+        if options["tracemalloc"]:
+            tracemalloc.start()
+
+        with temporary_database("outsider_loadtest.sqlite3"):
+            with override_settings(CHANNEL_LAYERS=self.channel_layers(options)):
+                stats = asyncio.run(run_load_test(options))
+
+        report = self.report(stats, options)
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+        else:
+            self.print_report(report)
+
+    def report(self, stats, options):
+        latencies = stats.all_latencies()
+        report = {
+            "rooms": stats.rooms,
+            "errors": stats.errors,
+            "players": options["rooms"] * options["players"],
+            "elapsed_s": round(stats.elapsed, 3),
+            "actions_per_s": round(stats.actions / stats.elapsed, 1),
+            "messages_per_s": round(stats.messages / stats.elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "actions": {
+                action: {
+                    "messages": len(values),
+                    "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                    "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                }
+                for action, values in stats.latencies.items()
+            },
+            "db_executor": executor.stats(),
+            # Kilobytes on Linux
+            "max_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        }
+        if options["tracemalloc"]:
+            report["heap_peak_mb"] = round(
+                tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1
+            )
+        return report
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['rooms']} rooms played ({report['errors']} errors), "
+            f"{report['players']} players in {report['elapsed_s']} s"
+        )
+        self.stdout.write(
+            f"Throughput: {report['actions_per_s']} actions/s, "
+            f"{report['messages_per_s']} messages/s"
+        )
+        self.stdout.write(
+            f"Latency (action to broadcast): p50 {report['p50_ms']} ms, "
+            f"p99 {report['p99_ms']} ms"
+        )
+        for action, values in report["actions"].items():
+            self.stdout.write(
+                f"  {action:<16} {values['messages']:>8} messages  "
+                f"p50 {values['p50_ms']:>8} ms  p99 {values['p99_ms']:>8} ms"
+            )
+
+        db = report["db_executor"]
+        self.stdout.write(
+            f"DB executor: {db['completed']} jobs on {db['workers']} threads, "
+            f"peak queue {db['peak_queued']}, mean wait {db['mean_wait_ms']} ms"
+        )
+
+        memory = f"Memory: max RSS {report['max_rss_mb']} MB"
+        if "heap_peak_mb" in report:
+            memory += f", Python heap peak {report['heap_peak_mb']} MB"
+        self.stdout.write(memory)
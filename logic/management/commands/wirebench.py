@@ -0,0 +1,137 @@
+import json
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+
+from logic.utils import wire
+from logic.utils.consumer_classes import State, WebsocketUser
+
+
+# Size and encode/decode time of the room messages for the JSON frames and the
+# MessagePack frames (wire.BINARY_SUBPROTOCOL). Every event changes one player, as a
+# turn does, and is encoded for every player of the room the way the consumers do (the
+# roster once, the frame once per recipient). JSON clients decode the frame and then the
+# nested strings ('user', 'actual_users'), binary clients decode a single frame.
+#
+#   python manage.py wirebench --players 6 --iterations 20000
+
+
+def room_players(count):
+    players = [
+        WebsocketUser(username=f"Player{index}", captain=index == 0)
+        for index in range(count)
+    ]
+    players[-1].outsider = True
+    return players
+
+
+def event_contents(players):
+    return {
+        "connection": {
+            "message_type": "connection",
+            "message": "Se ha unido a la sala",
+            "username": players[-1].username,
+            "disconnected_user": None,
+        },
+        "nextTurn": {"message_type": "nextTurn"},
+        "votingComplete": {
+            "message_type": "votingComplete",
+            "player_out": players[-1].to_dict(),
+            "continue_playing": True,
+            "number_outsiders": 1,
+        },
+        "roundStart": {"message_type": "startGame", "key_word": "Manzana"},
+    }
+
+
+def json_event(content, players):
+    roster = wire.encode_roster(players)
+    return [
+        wire.frame(
+            content, {"user": wire.encode_nested(player), "actual_users": roster}
+        )
+        for player in players
+    ]
+
+
+def msgpack_event(content, players):
+    roster = wire.packed_roster(players)
+    return [
+        wire.packed_frame(content, {"user": wire.pack(player), "actual_users": roster})
+        for player in players
+    ]
+
+
+def json_decode(frame):
+    message = json.loads(frame)
+    message["user"] = json.loads(message["user"])
+    message["actual_users"] = json.loads(message["actual_users"])
+    return message
+
+
+def msgpack_decode(frame):
+    return msgpack.unpackb(frame)
+
+
+CODECS = {
+    "json": (json_event, json_decode),
+    "msgpack": (msgpack_event, msgpack_decode),
+}
+
+
+def run_benchmark(codec, content, players, iterations):
+    encode_event, decode = CODECS[codec]
+
+    start = time.perf_counter()
+    for index in range(iterations):
+        players[index % len(players)].guessWord = f"Palabra{index}"
+        frames = encode_event(content, players)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(frames[0])
+    decode_time = time.perf_counter() - start
+
+    return {
+        "bytes": len(frames[0]),
+        "encode_us": round(encode_time / iterations * 1e6, 2),
+        "decode_us": round(decode_time / iterations * 1e6, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare the size and encode/decode time of the JSON and MessagePack frames"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--players", type=int, default=6)
+        parser.add_argument("--iterations", type=int, default=20000)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        players = room_players(options["players"])
+        players[0].state = State.PLAYER_TURN
+
+        report = {}
+        for event, content in event_contents(players).items():
+            report[event] = {
+                codec: run_benchmark(codec, content, players, options["iterations"])
+                for codec in CODECS
+            }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+
+        self.stdout.write(
+            f"{options['players']} players, {options['iterations']} iterations "
+            "(encode for the whole room, decode per frame)"
+        )
+        for event, results in report.items():
+            for codec, result in results.items():
+                self.stdout.write(
+                    f"  {event:<15} {codec:<8} {result['bytes']:>6} bytes  "
+                    f"encode {result['encode_us']:>8} us  "
+                    f"decode {result['decode_us']:>7} us"
+                )
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("logic", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="roommodel",
+            name="word_list",
+            field=models.CharField(
+                default="Current",
+                help_text="Nombre de la lista de palabras usada en la partida",
+                max_length=256,
+                verbose_name="Lista de palabras",
+            ),
+        ),
+    ]
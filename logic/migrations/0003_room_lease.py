@@ -0,0 +1,35 @@
+# Generated by Django 4.2.2 on 2026-10-18 19:26
+
+from django.db import migrations, models
+import logic.models.rooms
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("logic", "0002_room_word_list"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="roommodel",
+            name="lease_expires",
+            field=models.DateTimeField(
+                db_index=True,
+                default=logic.models.rooms.lease_expiry,
+                help_text="La sala se borra si su propietario no la renueva antes",
+                verbose_name="Fin de la concesión",
+            ),
+        ),
+        migrations.AddField(
+            model_name="roommodel",
+            name="owner",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="Proceso que juega la sala",
+                max_length=256,
+                verbose_name="Propietario",
+            ),
+        ),
+    ]
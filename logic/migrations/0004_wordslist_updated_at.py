@@ -0,0 +1,25 @@
+# Generated by Django 4.2.2 on 2026-10-18 20:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("logic", "0003_room_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="wordslistmodel",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True,
+                default=django.utils.timezone.now,
+                help_text="Los procesos comparan su copia de la lista con esta fecha",
+                verbose_name="Última modificación",
+            ),
+            preserve_default=False,
+        ),
+    ]
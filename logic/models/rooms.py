@@ -1,4 +1,13 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+
+def lease_expiry():
+    # Time for the first player of a new room to join it (see 'logic.utils.leases')
+    return timezone.now() + timedelta(seconds=getattr(settings, "ROOM_LEASE_TTL", 60))
 
 
 class RoomModel(models.Model):
@@ -41,5 +50,27 @@ class RoomModel(models.Model):
         default=False,
     )
 
+    word_list = models.CharField(
+        max_length=256,
+        default="Current",
+        verbose_name="Lista de palabras",
+        help_text="Nombre de la lista de palabras usada en la partida",
+    )
+
+    owner = models.CharField(
+        max_length=256,
+        default="",
+        blank=True,
+        verbose_name="Propietario",
+        help_text="Proceso que juega la sala",
+    )
+
+    lease_expires = models.DateTimeField(
+        default=lease_expiry,
+        db_index=True,
+        verbose_name="Fin de la concesión",
+        help_text="La sala se borra si su propietario no la renueva antes",
+    )
+
     def __str__(self):
         return self.name
@@ -19,5 +19,11 @@ class WordsListModel(models.Model):
         help_text="Donde 'a' es la pista para los jugadores y 'b' es la pista para los outsiders",
     )
 
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name="Última modificación",
+        help_text="Los procesos comparan su copia de la lista con esta fecha",
+    )
+
     def __str__(self):
         return self.name
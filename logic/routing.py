@@ -2,7 +2,13 @@
 from django.urls import re_path
 
 from . import consumers
+from .utils.sharding import RoomShardRouter
 
 websocket_urlpatterns = [
-    re_path(r"ws/room/(?P<room_name>\w+)/$", consumers.RoomConsumer.as_asgi()),
+    re_path(
+        r"ws/room/(?P<room_name>\w+)/$",
+        RoomShardRouter(
+            consumers.RoomConsumer.as_asgi(), consumers.RoomRelayConsumer.as_asgi()
+        ),
+    ),
 ]
@@ -0,0 +1,100 @@
+import pytest
+
+from channels.exceptions import ChannelFull
+
+from .utils.channel_layer import HybridChannelLayer
+
+
+# Single process hybrid layer (no Redis)
+
+
+async def test_local_send_and_receive():
+    layer = HybridChannelLayer(hosts=[], capacity=2)
+
+    channel = await layer.new_channel()
+    await layer.send(channel, {"type": "test.message", "value": 1})
+    await layer.send("room-shard.0", {"type": "test.message", "value": 2})
+
+    assert (await layer.receive(channel))["value"] == 1
+    assert (await layer.receive("room-shard.0"))["value"] == 2
+    assert channel not in layer.receive_buffer
+
+    await layer.send(channel, {"type": "test.message"})
+    await layer.send(channel, {"type": "test.message"})
+    with pytest.raises(ChannelFull):
+        await layer.send(channel, {"type": "test.message"})
+
+
+async def test_local_group_send():
+    layer = HybridChannelLayer(hosts=[], local_groups=["room_"])
+
+    channel_1 = await layer.new_channel()
+    channel_2 = await layer.new_channel()
+    await layer.group_add("room_test", channel_1)
+    await layer.group_add("room_test", channel_2)
+
+    message = {"type": "test.message", "value": 1}
+    await layer.group_send("room_test", message)
+    received_1 = await layer.receive(channel_1)
+    received_2 = await layer.receive(channel_2)
+    assert received_1 == received_2 == message
+    assert received_1 is not message
+
+    await layer.group_discard("room_test", channel_1)
+    await layer.group_send("room_test", message)
+    assert await layer.receive(channel_2) == message
+    assert channel_1 not in layer.receive_buffer
+
+    await layer.group_discard("room_test", channel_2)
+    assert "room_test" not in layer.groups
+
+
+def test_process_local_groups_and_channels():
+    layer = HybridChannelLayer(
+        hosts=["redis://localhost:6379"], local_groups=["room_"]
+    )
+
+    # Rooms never use Redis, other groups have one member per process
+    assert layer.is_local_group("room_test")
+    assert not layer.is_local_group("lobby")
+    assert layer.process_channel("lobby") == f"hybrid.{layer.client_prefix}!lobby"
+
+    assert layer.is_local_channel(f"specific.{layer.client_prefix}!abc")
+    assert not layer.is_local_channel("specific.other!abc")
+    assert not layer.is_local_channel("room-shard.0")
+
+
+async def test_send_many(settings):
+    # Two processes: the messages for the channels of the other go through Redis
+    layer_1 = HybridChannelLayer(hosts=settings.REDIS_HOSTS, capacity=2)
+    layer_2 = HybridChannelLayer(hosts=settings.REDIS_HOSTS, capacity=2)
+
+    local = await layer_1.new_channel()
+    remote_1 = await layer_2.new_channel()
+    remote_2 = await layer_2.new_channel()
+    await layer_1.send_many(
+        {
+            local: {"type": "test.message", "value": 1},
+            remote_1: {"type": "test.message", "value": 2},
+            remote_2: {"type": "test.message", "value": 3},
+        }
+    )
+
+    assert (await layer_1.receive(local))["value"] == 1
+    assert (await layer_2.receive(remote_1))["value"] == 2
+    assert (await layer_2.receive(remote_2))["value"] == 3
+
+    # Full channels drop their message, the others still get theirs
+    await layer_1.send(local, {"type": "test.message"})
+    await layer_1.send(local, {"type": "test.message"})
+    await layer_1.send_many(
+        {
+            local: {"type": "test.message", "value": 4},
+            remote_1: {"type": "test.message", "value": 5},
+        }
+    )
+    assert (await layer_2.receive(remote_1))["value"] == 5
+    assert layer_1.receive_buffer[local].qsize() == 2
+
+    await layer_1.close_pools()
+    await layer_2.close_pools()
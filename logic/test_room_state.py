@@ -0,0 +1,362 @@
+import asyncio
+import json
+import time
+import pytest
+
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from .models import RoomModel, WordsListModel
+from .utils import (
+    leases,
+    sync_rest_calls,
+    room_state,
+    room_persistence,
+    sqlite_profile,
+    word_lists,
+)
+from .utils.consumer_classes import State, WebsocketUser
+from .utils.db_executor import DatabaseExecutor
+from .utils.voting import VoteTally
+from .utils.word_lists import WordBag, WordList
+
+
+# Testing -> room state and write-behind persistence (no Redis needed)
+
+test_room = "test_state_room"
+
+
+@pytest.mark.django_db()
+async def test_room_updates_are_coalesced(settings):
+    settings.ROOM_STORE = "database"
+    await sync_rest_calls.create_room(room_name=test_room)
+    room = await room_state.get_room(room_name=test_room)
+
+    room.add_player("User1")
+    await room_state.save_room(room)
+    room.add_player("User2")
+    await room_state.save_room(room)
+
+    # Both updates are pending as a single entry with only the changed field
+    assert room_persistence.queue.pending[test_room][1] == {"current_connections"}
+
+    await room_persistence.flush()
+    assert not room_persistence.queue.pending
+
+    db_room = await sync_rest_calls.get_room(room_name=test_room)
+    assert [player["username"] for player in db_room.current_connections] == [
+        "User1",
+        "User2",
+    ]
+    assert db_room.current_connections[0]["captain"] == True
+
+    await room_state.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_failed_room_writes_are_retried(settings, monkeypatch):
+    settings.ROOM_STORE = "database"
+    await sync_rest_calls.create_room(room_name=test_room)
+    room = await room_state.get_room(room_name=test_room)
+
+    async def locked(batch):
+        raise Exception("database is locked")
+
+    update_rooms_state = sync_rest_calls.update_rooms_state
+    monkeypatch.setattr(sync_rest_calls, "update_rooms_state", locked)
+
+    room.add_player("User1")
+    room.started_game = True
+    room.mark_changed("started_game")
+    await room_state.save_room(room)
+    with pytest.raises(Exception):
+        await room_persistence.flush()
+
+    # The fields of the failed batch are written by the next one
+    assert room_persistence.queue.pending[test_room][1] == {
+        "current_connections",
+        "started_game",
+    }
+    monkeypatch.setattr(sync_rest_calls, "update_rooms_state", update_rooms_state)
+    await room_persistence.flush()
+    assert not room_persistence.queue.pending
+
+    db_room = await sync_rest_calls.get_room(room_name=test_room)
+    assert db_room.started_game == True
+    assert [player["username"] for player in db_room.current_connections] == ["User1"]
+
+    await room_state.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_room_players_partial_updates(settings):
+    settings.ROOM_STORE = "database"
+    await sync_rest_calls.create_room(room_name=test_room)
+    room = await room_state.get_room(room_name=test_room)
+
+    user_1 = room.add_player("User1")
+    user_2 = room.add_player("User2")
+    await room_state.save_room(room)
+    await room_persistence.flush()
+
+    # Only the changed player and the new one (JSONB operators on PostgreSQL)
+    user_2.state = State.OUT
+    room.add_player("User3")
+    changed, joined = room_persistence.players_patch(room)
+    assert list(changed) == [user_2.id]
+    assert [player["username"] for player in joined] == ["User3"]
+
+    await room_state.save_room(room)
+    await room_persistence.flush()
+    assert room_persistence.players_patch(room) == ({}, [])
+
+    db_room = await sync_rest_calls.get_room(room_name=test_room)
+    assert db_room.current_connections == [
+        player.to_dict() for player in room.current_connections
+    ]
+
+    # A player leaving rewrites every player
+    room.remove_player(user_1)
+    assert room_persistence.players_patch(room) is None
+
+    await room_state.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_room_players_jsonb_patch(settings):
+    if connection.vendor != "postgresql":
+        pytest.skip("PostgreSQL only")
+
+    settings.ROOM_STORE = "database"
+    await sync_rest_calls.create_room(room_name=test_room)
+    room = await room_state.get_room(room_name=test_room)
+
+    user_1 = room.add_player("User1")
+    user_2 = room.add_player("User2")
+    await room_state.save_room(room)
+    await room_persistence.flush()
+
+    # Unchanged players are not written again, their entries keep this mark
+    stored = [dict(player.to_dict(), mark=True) for player in room.current_connections]
+    await RoomModel.objects.filter(name=test_room).aupdate(current_connections=stored)
+
+    user_2.guessWord = "Palabra"
+    user_3 = room.add_player("User3")
+    assert room_persistence.players_patch(room) is not None
+    await room_state.save_room(room)
+    await room_persistence.flush()
+
+    db_room = await RoomModel.objects.aget(name=test_room)
+    assert db_room.current_connections == [
+        dict(user_1.to_dict(), mark=True),
+        user_2.to_dict(),
+        user_3.to_dict(),
+    ]
+
+    await room_state.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_orphaned_room_is_reclaimed(settings):
+    settings.ROOM_STORE = "database"
+    await sync_rest_calls.create_room(room_name=test_room)
+
+    # Players and game of a process that is gone
+    db_room = await sync_rest_calls.get_room(room_name=test_room)
+    db_room.current_connections = [WebsocketUser("User1", captain=True).to_dict()]
+    db_room.started_game = True
+    await sync_rest_calls.update_room(db_room)
+
+    room = await room_state.get_room(room_name=test_room)
+    assert room.current_connections == []
+    assert room.started_game == False
+
+    db_room = await sync_rest_calls.get_room(room_name=test_room)
+    assert db_room.current_connections == []
+    assert db_room.started_game == False
+
+    await room_state.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+def test_bootstrap_command():
+    RoomModel.objects.create(name=test_room)
+    WordsListModel.objects.update_or_create(
+        name="Current", defaults={"word_list": ""}
+    )
+
+    # The rooms are only deleted on request
+    call_command("bootstrap")
+    assert WordsListModel.objects.get(name="Current").word_list
+    assert RoomModel.objects.filter(name=test_room).exists()
+
+    call_command("bootstrap", "--clean-rooms")
+    assert not RoomModel.objects.exists()
+
+
+@pytest.mark.django_db()
+async def test_expired_room_leases_are_reaped(settings):
+    settings.ROOM_STORE = "database"
+    names = [f"{test_room}_{index}" for index in range(4)]
+    for name in names:
+        await sync_rest_calls.create_room(room_name=name)
+
+    # The last room is played by this process
+    await room_state.get_room(room_name=names[3])
+
+    expired = timezone.now() - timedelta(seconds=1)
+    await RoomModel.objects.filter(name__in=names[1:]).aupdate(lease_expires=expired)
+
+    # Bounded batches, the active room and the room with a lease are kept
+    assert await leases.reap(batch_size=1) == 1
+    assert await leases.reap(batch_size=1) == 1
+    assert await leases.reap(batch_size=1) == 0
+
+    remaining = RoomModel.objects.filter(name__in=names).order_by("name")
+    assert [room.name async for room in remaining] == [names[0], names[3]]
+
+    await leases.renew()
+    db_room = await RoomModel.objects.aget(name=names[3])
+    assert db_room.owner == leases.worker_id
+    assert db_room.lease_expires > timezone.now()
+
+    await room_state.delete_room(room_name=names[3])
+    await sync_rest_calls.delete_room(room_name=names[0])
+
+
+async def test_db_executor_orders_jobs_of_each_room():
+    executor = DatabaseExecutor(workers=2, max_queued=10)
+    done = []
+
+    def job(name, delay=0):
+        time.sleep(delay)
+        done.append(name)
+
+    # The slow job only delays the next one of its room
+    await asyncio.gather(
+        executor.run(["room_1"], job, "first_1", 0.1),
+        executor.run(["room_1"], job, "second_1"),
+        executor.run(["room_2"], job, "first_2"),
+    )
+
+    assert done == ["first_2", "first_1", "second_1"]
+    assert not executor.tails
+
+    stats = executor.stats()
+    assert stats["completed"] == 3
+    assert stats["queued"] == stats["running"] == 0
+    # The second job of 'room_1' waited for the first one
+    assert stats["peak_queued"] == 2
+
+
+@pytest.mark.django_db()
+def test_sqlite_profile_pragmas():
+    if connection.vendor != "sqlite":
+        pytest.skip("SQLite only")
+
+    def pragma(name):
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    # The test database is in memory, so no write-ahead log or memory map
+    profile = sqlite_profile.PROFILES["wal"]
+    assert pragma("synchronous") == 1
+    assert pragma("busy_timeout") == profile["busy_timeout"]
+    assert pragma("cache_size") == profile["cache_size"]
+
+
+def test_vote_tally():
+    tally = VoteTally(voters=["p1", "p2", "p3", "p4"])
+
+    assert tally.cast("p1", "p2")
+    assert tally.cast("p2", "p3")
+    # Only one ballot per eligible voter
+    assert not tally.cast("p2", "p2")
+    assert not tally.cast("spectator", "p2")
+    assert tally.result() == ""
+
+    assert tally.cast("p3", "p2")
+    assert not tally.complete
+    assert tally.result() == "p2"
+
+    tally.remove_voter("p4")
+    assert tally.complete
+    assert tally.result() == "p2"
+
+
+def test_word_bag_never_repeats_words():
+    words = [{"a": f"a{i}", "b": f"b{i}"} for i in range(50)]
+    word_list = WordList("Test", words)
+
+    bag = WordBag(word_list, used=words[:10])
+    drawn = [bag.draw() for _ in range(40)]
+
+    assert bag.draw() is None
+    assert sorted(word["a"] for word in drawn) == sorted(
+        word["a"] for word in words[10:]
+    )
+
+
+@pytest.mark.django_db()
+async def test_word_lists_lru_cache(settings):
+    settings.WORD_LISTS_CACHE_SIZE = 1
+    word_lists.word_lists.clear()
+
+    await sync_rest_calls.create_word_list("Spanish", [{"a": "Sol", "b": "Brillo"}])
+    await sync_rest_calls.create_word_list("English", [{"a": "Sun", "b": "Shine"}])
+
+    spanish = await word_lists.get_word_list(name="Spanish")
+    assert spanish.words[0]["a"] == "Sol"
+    assert await word_lists.get_word_list(name="Spanish") is spanish
+
+    english = await word_lists.get_word_list(name="English")
+    assert english.words[0]["a"] == "Sun"
+    assert list(word_lists.word_lists) == ["English"]
+
+
+
+@pytest.mark.django_db()
+def test_room_creation_word_list(client):
+    # Only names of existing lists are accepted
+    for word_list in [5, ["Current"], "Missing"]:
+        response = client.post(
+            "/logic/rooms/",
+            {"name": "word_list_room", "word_list": word_list},
+            content_type="application/json",
+        )
+        assert response.status_code == 400
+    assert not RoomModel.objects.filter(name="word_list_room").exists()
+
+
+@pytest.mark.django_db()
+async def test_word_lists_changed_by_other_processes():
+    word_lists.word_lists.clear()
+    await sync_rest_calls.create_word_list("Catalan", [{"a": "Sol", "b": "Llum"}])
+    catalan = await word_lists.get_word_list(name="Catalan")
+
+    # Saved by another worker: no signal in this process, only the modification time
+    await WordsListModel.objects.filter(name="Catalan").aupdate(
+        word_list=[{"a": "Lluna", "b": "Nit"}], updated_at=timezone.now()
+    )
+    changed = await word_lists.get_word_list(name="Catalan")
+    assert changed is not catalan
+    assert changed.words[0]["a"] == "Lluna"
+    assert await word_lists.get_word_list(name="Catalan") is changed
+
+
+def test_player_record_wire_encoding():
+    player = WebsocketUser(username="User1", captain=True, outsider=True)
+    version = player.version
+
+    # The other players only see the outsider flag once the player is out
+    assert json.loads(player.to_wire())["outsider"] == False
+    assert player.to_wire() is player.to_wire()
+
+    player.state = State.OUT
+    assert player.version > version
+    assert json.loads(player.to_wire()) == player.to_dict()
+    assert WebsocketUser.from_dict(player.to_dict()).to_dict() == player.to_dict()
@@ -1,13 +1,28 @@
 import pytest
 import json
+import asyncio
+import msgpack
 
+from autobahn.websocket.compress import PerMessageDeflate, PerMessageDeflateOffer
+from autobahn.websocket.protocol import WebSocketProtocol
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
 from django.urls import re_path
 
-from .consumers import RoomConsumer
-from .utils.consumer_classes import State
-from .utils import sync_rest_calls
+from .consumers import RoomConsumer, RoomRelayConsumer
+from .management.commands.loadtest import run_load_test
+from .routing import websocket_urlpatterns
+from .utils.consumer_classes import State, WebsocketUser
+from .utils import (
+    deflate,
+    lifecycle,
+    room_state,
+    room_store,
+    sync_rest_calls,
+    sharding,
+    wire,
+)
 
 
 # Aux. methods and fixtures
@@ -151,6 +166,31 @@ async def test_room_connection_started_game_room(create_test_room):
 
     connected, subprotocol = await communicator.connect()
     assert connected == False
+    assert test_room not in room_state.rooms
+
+    await sync_rest_calls.delete_room(room_name=test_room)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_room_released_by_sockets_without_player(create_test_room):
+    def communicator():
+        return WebsocketCommunicator(
+            application=URLRouter(
+                [re_path(r"ws/room/(?P<room_name>\w+)/$", RoomConsumer.as_asgi())]
+            ),
+            path=f"ws/room/{test_room}/",
+        )
+
+    # The room is kept while one of its sockets is open, even without players
+    communicator_1, communicator_2 = communicator(), communicator()
+    assert (await communicator_1.connect())[0] == True
+    assert (await communicator_2.connect())[0] == True
+    await communicator_1.disconnect()
+    assert test_room in room_state.rooms
+
+    await communicator_2.disconnect()
+    assert test_room not in room_state.rooms
 
     await sync_rest_calls.delete_room(room_name=test_room)
 
@@ -369,15 +409,24 @@ async def test_next_turn(create_test_room):
     communicator_2, response_2 = await communicator_connection(username="User2")
     response_1 = await communicator_1.receive_json_from()
 
+    # Sockets without a player also receive the turns of the room
+    guest = WebsocketCommunicator(
+        application=URLRouter(
+            [re_path(r"ws/room/(?P<room_name>\w+)/$", RoomConsumer.as_asgi())]
+        ),
+        path=f"ws/room/{test_room}/",
+    )
+    assert (await guest.connect())[0] == True
+
     await communicator_1.send_json_to({"action": "startGame", "message": ""})
     response_1 = await communicator_1.receive_json_from()
     response_2 = await communicator_2.receive_json_from()
 
-    order = json.loads(response_1["actual_users"])
-
-    await communicator_1.send_json_to(
-        {"action": "nextTurn", "message": "guessWord", "order": order}
-    )
+    # The player with the turn passes it, the order is kept by the room
+    if json.loads(response_1["user"])["state"] == State.PLAYER_TURN:
+        await communicator_1.send_json_to({"action": "nextTurn", "message": "guessWord"})
+    else:
+        await communicator_2.send_json_to({"action": "nextTurn", "message": "guessWord"})
 
     response_1 = await communicator_1.receive_json_from()
     user_1 = json.loads(response_1["user"])
@@ -394,11 +443,59 @@ async def test_next_turn(create_test_room):
     else:
         assert False
 
+    response_guest = await guest.receive_json_from()
+    assert response_guest["message_type"] == "nextTurn"
+    assert response_guest["user"] == ""
+
+    # Only the room changes the turn, the roster sent has every change
+    assert room_state.rooms[test_room].roster_delta()[1] == []
+
+    await guest.disconnect()
     await communicator_1.disconnect()
     await communicator_2.disconnect()
     assert await check_room_does_not_exist(room_name=test_room)
 
 
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_server_turn_order(create_test_room):
+    communicators = []
+    for username in ["User1", "User2", "User3"]:
+        communicator, response = await communicator_connection(username=username)
+        for other in communicators:
+            await other.receive_json_from()
+        communicators.append(communicator)
+
+    await communicators[0].send_json_to({"action": "startGame", "message": ""})
+    responses = [
+        await communicator.receive_json_from() for communicator in communicators
+    ]
+    order = [player["id"] for player in json.loads(responses[0]["actual_users"])]
+    users = [json.loads(response["user"])["id"] for response in responses]
+
+    # Only the player with the turn can pass it (clients don't send the order)
+    waiting = communicators[users.index(order[1])]
+    await waiting.send_json_to({"action": "nextTurn", "message": "word"})
+    assert await waiting.receive_nothing()
+
+    for turn, player_id in enumerate(order):
+        player = communicators[users.index(player_id)]
+        await player.send_json_to({"action": "nextTurn", "message": f"word{turn}"})
+
+        responses = [
+            await communicator.receive_json_from() for communicator in communicators
+        ]
+        roster = json.loads(responses[0]["actual_users"])
+        assert roster[turn]["guessWord"] == f"word{turn}"
+        assert [player["state"] == State.PLAYER_TURN for player in roster] == [
+            i == turn + 1 for i in range(3)
+        ]
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
 @pytest.mark.django_db()
 @pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
 async def test_voting_outsider(create_test_room):
@@ -762,3 +859,448 @@ async def test_end_game(create_test_room):
     response_2 = await communicator_2.receive_json_from()
 
     assert await check_room_does_not_exist(room_name=test_room)
+
+    # The finished game leaves no channels in the local room group (plain Redis groups
+    # expire)
+    await communicator_1.disconnect()
+    await communicator_2.disconnect()
+    assert f"room_{test_room}" not in getattr(get_channel_layer(), "groups", {})
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_action_rules(create_test_room):
+    communicator_1, response_1 = await communicator_connection(username="User1")
+    communicator_2, response_2 = await communicator_connection(username="User2")
+    response_1 = await communicator_1.receive_json_from()
+
+    # Unknown actions, invalid messages and players joining twice are ignored
+    await communicator_1.send_json_to({"action": "unknown", "message": ""})
+    await communicator_1.send_json_to({"action": ["startGame"], "message": ""})
+    await communicator_1.send_json_to({"action": {"name": "x"}, "message": ""})
+    await communicator_1.send_json_to({"action": "connection", "message": ""})
+    await communicator_1.send_json_to({"action": "nextTurn", "message": ["word"]})
+    # Only the captain starts the game, and only in the lobby
+    await communicator_2.send_json_to({"action": "startGame", "message": ""})
+    # No game yet
+    await communicator_1.send_json_to({"action": "lastChance", "message": "word"})
+    assert await communicator_1.receive_nothing()
+    assert await communicator_2.receive_nothing()
+
+    await communicator_1.send_json_to({"action": "startGame", "message": ""})
+    response_1 = await communicator_1.receive_json_from()
+    response_2 = await communicator_2.receive_json_from()
+    assert response_1["message_type"] == response_2["message_type"] == "startGame"
+
+    await communicator_1.send_json_to({"action": "startGame", "message": ""})
+    await communicator_2.send_json_to({"action": "nextRound", "message": ""})
+    assert await communicator_1.receive_nothing()
+    assert await communicator_2.receive_nothing()
+
+    await communicator_1.disconnect()
+    await communicator_2.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_roster_delta_protocol(create_test_room):
+    communicator_1 = WebsocketCommunicator(
+        application=URLRouter(
+            [re_path(r"ws/room/(?P<room_name>\w+)/$", RoomConsumer.as_asgi())]
+        ),
+        path=f"ws/room/{test_room}/",
+    )
+    connected, subprotocol = await communicator_1.connect()
+    assert connected == True
+
+    # Clients asking for "delta" rosters get the whole roster only when they join...
+    await communicator_1.send_json_to(
+        {"action": "connection", "message": "", "username": "User1", "roster": "delta"}
+    )
+    response_1 = await communicator_1.receive_json_from()
+    assert "actual_users" not in response_1
+    assert [player["username"] for player in response_1["roster"]] == ["User1"]
+    seq = response_1["roster_seq"]
+
+    # ... and only the changes on the next messages
+    communicator_2, response_2 = await communicator_connection(username="User2")
+    response_1 = await communicator_1.receive_json_from()
+    assert response_1["roster_seq"] == seq + 1
+    assert len(response_1["roster_delta"]) == 1
+    assert response_1["roster_delta"][0]["op"] == "join"
+    assert response_1["roster_delta"][0]["player"]["username"] == "User2"
+
+    # Current clients keep receiving the whole roster
+    assert len(json.loads(response_2["actual_users"])) == 2
+
+    await communicator_1.send_json_to({"action": "resync", "message": ""})
+    response_1 = await communicator_1.receive_json_from()
+    assert response_1["message_type"] == "roster"
+    assert response_1["roster_seq"] == seq + 1
+    assert len(response_1["roster"]) == 2
+    assert await communicator_2.receive_nothing()
+
+    await communicator_2.disconnect()
+    response_1 = await communicator_1.receive_json_from()
+    assert response_1["message_type"] == "disconnection"
+    assert response_1["roster_delta"][0] == {
+        "op": "leave",
+        "id": json.loads(response_2["user"])["id"],
+    }
+
+    await communicator_1.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_msgpack_subprotocol(create_test_room):
+    communicator_1 = WebsocketCommunicator(
+        application=URLRouter(
+            [re_path(r"ws/room/(?P<room_name>\w+)/$", RoomConsumer.as_asgi())]
+        ),
+        path=f"ws/room/{test_room}/",
+        subprotocols=["outsider.msgpack.v1"],
+    )
+    connected, subprotocol = await communicator_1.connect()
+    assert connected == True
+    assert subprotocol == "outsider.msgpack.v1"
+
+    # Binary frames both ways, the roster and the user are nested
+    await communicator_1.send_to(
+        bytes_data=msgpack.packb(
+            {"action": "connection", "message": "", "username": "User1"}
+        )
+    )
+    response_1 = msgpack.unpackb(await communicator_1.receive_from())
+    assert response_1["message_type"] == "connection"
+    assert response_1["user"]["username"] == "User1"
+    assert [player["username"] for player in response_1["actual_users"]] == ["User1"]
+
+    # JSON clients of the same room are not affected
+    communicator_2, response_2 = await communicator_connection(username="User2")
+    assert len(json.loads(response_2["actual_users"])) == 2
+    response_1 = msgpack.unpackb(await communicator_1.receive_from())
+    assert response_1["actual_users"][1]["username"] == "User2"
+    assert response_1["actual_users"][1]["outsider"] == False
+
+    await communicator_1.send_to(
+        bytes_data=msgpack.packb({"action": "default", "message": "Hola"})
+    )
+    response_1 = msgpack.unpackb(await communicator_1.receive_from())
+    assert response_1 == {"message_type": "default", "message": "Hola", "username": ""}
+    response_2 = await communicator_2.receive_json_from()
+    assert response_2["message"] == "Hola"
+
+    await communicator_2.disconnect()
+    response_1 = msgpack.unpackb(await communicator_1.receive_from())
+    assert response_1["message_type"] == "disconnection"
+    assert len(response_1["actual_users"]) == 1
+
+    await communicator_1.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+def test_websocket_deflate(settings, monkeypatch):
+    def compressed_sizes(accept, frames):
+        compressor = PerMessageDeflate.create_from_offer_accept(True, accept)
+        sizes = []
+        for frame in frames:
+            compressor.start_compress_message()
+            data = compressor.compress_message_data(frame)
+            sizes.append(len(data + compressor.end_compress_message()))
+        return sizes
+
+    players = [WebsocketUser(f"User{index}", index == 0) for index in range(6)]
+    frame = wire.frame(
+        {"message_type": "nextTurn"}, {"actual_users": wire.encode_roster(players)}
+    )
+    frames = [frame.encode()] * 2
+
+    # The roster repeats the previous message, with a shared context it is almost free
+    settings.WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER = True
+    accept = deflate.accept_offer([PerMessageDeflateOffer()])
+    assert accept.no_context_takeover is None
+    shared = compressed_sizes(accept, frames)
+    assert shared[1] < shared[0] / 4 < len(frame) / 4
+
+    settings.WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER = False
+    accept = deflate.accept_offer([PerMessageDeflateOffer()])
+    assert accept.no_context_takeover and accept.request_no_context_takeover
+    assert compressed_sizes(accept, frames) == [shared[0], shared[0]]
+
+    settings.WEBSOCKET_DEFLATE = False
+    assert deflate.accept_offer([PerMessageDeflateOffer()]) is None
+
+    # Frames below the threshold are sent uncompressed
+    sent = []
+    monkeypatch.setattr(
+        WebSocketProtocol,
+        "sendMessage",
+        lambda self, payload, isBinary=False, doNotCompress=False: sent.append(
+            doNotCompress
+        ),
+    )
+    protocol = deflate.DeflateWebSocketProtocol()
+    protocol.factory = type("Factory", (), {"deflate_threshold": 256})
+    protocol.sendMessage(b'{"message_type": "ping"}')
+    protocol.sendMessage(frames[0])
+    assert sent == [True, False]
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_room_owned_by_another_shard(create_test_room, settings):
+    # This worker doesn't own the room, its owner shard listens in the same process
+    settings.ROOM_SHARDS = 2
+    owner = sharding.shard_for(test_room)
+    settings.ROOM_SHARD = 1 - owner
+
+    room_app = RoomConsumer.as_asgi()
+    sharding.listener.start(room_app, shard=owner)
+
+    communicator = WebsocketCommunicator(
+        application=URLRouter(
+            [
+                re_path(
+                    r"ws/room/(?P<room_name>\w+)/$",
+                    sharding.RoomShardRouter(room_app, RoomRelayConsumer.as_asgi()),
+                )
+            ]
+        ),
+        path=f"ws/room/{test_room}/",
+    )
+
+    connected, subprotocol = await communicator.connect()
+    assert connected == True
+
+    await communicator.send_json_to(
+        {"action": "connection", "message": "", "username": "User1"}
+    )
+    response = await communicator.receive_json_from()
+    assert response["message_type"] == "connection"
+    assert json.loads(response["user"])["username"] == "User1"
+
+    await communicator.disconnect()
+
+    # The owner handles the relayed disconnection on its own
+    for _ in range(20):
+        if await check_room_does_not_exist(room_name=test_room):
+            break
+        await asyncio.sleep(0.05)
+    assert await check_room_does_not_exist(room_name=test_room)
+
+    sharding.listener.task.cancel()
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_shard_listens_from_worker_start(create_test_room, settings):
+    # The owner worker starts and the first websocket of the room reaches another worker
+    settings.ROOM_SHARDS = 2
+    owner = sharding.shard_for(test_room)
+    settings.ROOM_SHARD = owner
+    await lifecycle.warmup()
+
+    settings.ROOM_SHARD = 1 - owner
+    communicator = WebsocketCommunicator(
+        application=URLRouter(websocket_urlpatterns), path=f"ws/room/{test_room}/"
+    )
+    connected, subprotocol = await communicator.connect()
+    assert connected == True
+
+    await communicator.send_json_to(
+        {"action": "connection", "message": "", "username": "User1"}
+    )
+    response = await communicator.receive_json_from()
+    assert json.loads(response["user"])["username"] == "User1"
+
+    await communicator.disconnect()
+    for _ in range(20):
+        if await check_room_does_not_exist(room_name=test_room):
+            break
+        await asyncio.sleep(0.05)
+    assert await check_room_does_not_exist(room_name=test_room)
+
+    sharding.listener.task.cancel()
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_draining_worker(create_test_room, monkeypatch):
+    # Restored when the test ends
+    monkeypatch.setattr(lifecycle, "draining", False)
+
+    communicator, response = await communicator_connection("User1")
+    assert response["message_type"] == "connection"
+
+    # A stopping worker keeps its rooms but doesn't accept new websockets
+    drain = asyncio.create_task(lifecycle.drain(grace=5))
+    await asyncio.sleep(0)
+    assert lifecycle.draining == True
+
+    other_communicator, response = await communicator_connection("User2")
+    assert other_communicator is None
+    assert not drain.done()
+
+    await communicator.disconnect()
+    await asyncio.wait_for(drain, timeout=2)
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_turn_and_voting_deadlines(create_test_room, settings):
+    settings.TURN_TIMEOUT = 0.1
+    settings.VOTING_TIMEOUT = 0.2
+
+    communicator_1, response_1 = await communicator_connection(username="User1")
+    communicator_2, response_2 = await communicator_connection(username="User2")
+    response_1 = await communicator_1.receive_json_from()
+
+    await communicator_1.send_json_to({"action": "startGame", "message": ""})
+    await communicator_1.receive_json_from()
+    await communicator_2.receive_json_from()
+
+    # Nobody plays, every turn passes to the next player on its own
+    for turn in range(2):
+        response_1 = await communicator_1.receive_json_from(timeout=2)
+        response_2 = await communicator_2.receive_json_from(timeout=2)
+        assert response_1["message_type"] == response_2["message_type"] == "nextTurn"
+
+    states = [player["state"] for player in json.loads(response_1["actual_users"])]
+    assert states == [State.PLAYING, State.PLAYING]
+
+    # Nobody votes, the voting closes without any player out
+    response_1 = await communicator_1.receive_json_from(timeout=2)
+    response_2 = await communicator_2.receive_json_from(timeout=2)
+    assert response_1["message_type"] == response_2["message_type"] == "votingComplete"
+    assert response_1["player_out"] == ""
+
+    await communicator_1.disconnect()
+    await communicator_2.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize("create_test_room", [test_room], indirect=True)
+async def test_heartbeat_evicts_idle_connections(create_test_room, settings):
+    settings.HEARTBEAT_INTERVAL = 0.2
+    settings.HEARTBEAT_GRACE = 0.2
+    settings.HEARTBEAT_TICK = 0.05
+
+    communicator_1 = WebsocketCommunicator(
+        application=URLRouter(
+            [re_path(r"ws/room/(?P<room_name>\w+)/$", RoomConsumer.as_asgi())]
+        ),
+        path=f"ws/room/{test_room}/",
+    )
+    connected, subprotocol = await communicator_1.connect()
+    assert connected == True
+
+    await communicator_1.send_json_to(
+        {"action": "connection", "message": "", "username": "User1", "heartbeat": True}
+    )
+    await communicator_1.receive_json_from()
+
+    # Clients without heartbeat are never pinged
+    communicator_2, response_2 = await communicator_connection("User2")
+    await communicator_1.receive_json_from()
+
+    # Answering the ping keeps the connection
+    response_1 = await communicator_1.receive_json_from(timeout=2)
+    assert response_1["message_type"] == "ping"
+    await communicator_1.send_json_to({"action": "pong"})
+    assert (await communicator_1.receive_json_from(timeout=2))["message_type"] == "ping"
+
+    # A silent client is closed and leaves the room as on a disconnection (sent by the
+    # server once the websocket is closed)
+    assert (await communicator_1.receive_output(timeout=2))["type"] == "websocket.close"
+    await communicator_1.send_input({"type": "websocket.disconnect", "code": 4008})
+    response_2 = await communicator_2.receive_json_from(timeout=2)
+    assert response_2["message_type"] == "disconnection"
+    assert response_2["disconnected_user"]["username"] == "User1"
+    assert json.loads(response_2["user"])["captain"] == True
+    assert await communicator_2.receive_nothing(timeout=0.5)
+
+    await communicator_2.disconnect()
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_redis_room_store_shared_operations(settings):
+    settings.ROOM_STORE = "redis"
+    store = room_store.get_store()
+    # Also clears any state left in Redis by a room with the same name
+    await sync_rest_calls.create_room(room_name=test_room)
+
+    # The same room loaded by two workers
+    room_1 = room_state.Room(test_room, **await store.load(test_room))
+    room_2 = room_state.Room(test_room, **await store.load(test_room))
+
+    # Simultaneous joins keep both players and a single captain
+    user_1, user_2 = await asyncio.gather(
+        room_state.join_room(room_1, "User1"),
+        room_state.join_room(room_2, "User2"),
+    )
+    assert user_1.captain != user_2.captain
+
+    user_3 = await room_state.join_room(room_1, "User3")
+    user_3.outsider = True
+    await store.save(room_1, {"current_connections"})
+
+    players = (await store.load(test_room))["current_connections"]
+    assert [player["username"] for player in players][2] == "User3"
+    assert [player["captain"] for player in players] == [True, False, False]
+
+    # The captain leaves from its worker, the next player in order is the captain
+    captain, other, room = (
+        (user_1, user_2, room_1) if user_1.captain else (user_2, user_1, room_2)
+    )
+    await room_state.leave_room(room, captain)
+
+    state = await store.load(test_room)
+    assert [player["id"] for player in state["current_connections"]] == [
+        other.id,
+        user_3.id,
+    ]
+    assert state["current_connections"][0]["captain"] == True
+
+    player_out, next_captain, can_continue = await room_state.eliminate_player(
+        room_1, user_3.id
+    )
+    assert player_out is user_3
+    assert can_continue == False
+    assert room_1.number_outsiders == 0
+
+    state = await store.load(test_room)
+    assert state["number_outsiders"] == 0
+    assert state["current_connections"][1]["state"] == State.OUT
+
+    # A reclaimed room keeps no entries of its previous players
+    room_1.reclaim()
+    await store.save(room_1, {"current_connections", "started_game"})
+    fields = await store.redis.hkeys(store.key(test_room))
+    assert "order" in fields
+    assert not [field for field in fields if field.startswith("player:")]
+    assert (await store.load(test_room))["current_connections"] == []
+
+    await room_state.delete_room(room_name=test_room)
+    assert not await store.redis.exists(store.key(test_room))
+    assert await check_room_does_not_exist(room_name=test_room)
+
+
+@pytest.mark.django_db()
+async def test_load_test_bots():
+    stats = await run_load_test(
+        {"rooms": 3, "players": 4, "rounds": 2, "think": 0, "timeout": 5}
+    )
+
+    assert stats.rooms == 3
+    assert stats.errors == 0
+    for action in ["connection", "startGame", "nextTurn", "votingOutsider", "endGame"]:
+        assert stats.latencies[action]
+
+    for index in range(3):
+        assert await check_room_does_not_exist(room_name=f"loadtest_{index}")
@@ -0,0 +1,73 @@
+# Registry of the actions a client can send to 'RoomConsumer' ({"action": ...}). Every
+# handler declares the fields of its message, who can send it and in which phases of the
+# room (see 'Room.phase'), and the consumer finds it with a single lookup. The checks are
+# put together once, when the consumer class is created, so a new action only needs its
+# handler.
+
+# Roles
+ANYONE = "anyone"
+# Connected, but not playing yet
+GUEST = "guest"
+PLAYER = "player"
+CAPTAIN = "captain"
+# The player with the turn
+TURN = "turn"
+
+# Phases
+LOBBY = "lobby"
+GAME = "game"
+
+ROLES = {
+    ANYONE: lambda consumer: True,
+    GUEST: lambda consumer: consumer.user is None,
+    PLAYER: lambda consumer: consumer.user is not None,
+    CAPTAIN: lambda consumer: consumer.user is not None and consumer.user.captain,
+    TURN: lambda consumer: consumer.user is not None
+    and consumer.room.current_turn() is consumer.user,
+}
+
+
+class Action:
+    def __init__(self, name, handler, schema, optional, role, phases):
+        self.name = name
+        self.handler = handler
+        # (field, types, required)
+        self.fields = [(field, types, True) for field, types in schema.items()]
+        self.fields += [(field, types, False) for field, types in optional.items()]
+        self.allowed_role = ROLES[role]
+        self.phases = frozenset(phases) if phases else None
+
+    def valid(self, content):
+        for field, types, required in self.fields:
+            if field not in content:
+                if required:
+                    return False
+            elif not isinstance(content[field], types):
+                return False
+        return True
+
+    def allowed(self, consumer):
+        if self.phases is not None and consumer.room.phase not in self.phases:
+            return False
+        return self.allowed_role(consumer)
+
+
+def action(name, schema=None, optional=None, role=ANYONE, phases=None):
+    # Every message has a "message" field, of any type unless the schema says otherwise
+    schema = {"message": object, **(schema or {})}
+
+    def decorator(handler):
+        handler.action = Action(name, handler, schema, optional or {}, role, phases)
+        return handler
+
+    return decorator
+
+
+def register(cls):
+    # Class decorator, collects the actions of the class and its bases in 'cls.actions'
+    cls.actions = {}
+    for klass in reversed(cls.__mro__):
+        for value in vars(klass).values():
+            if isinstance(getattr(value, "action", None), Action):
+                cls.actions[value.action.name] = value.action
+    return cls
@@ -0,0 +1,251 @@
+import asyncio
+import collections
+import time
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+
+# Redis channel layer with an in-process fast path. Messages for channels of this
+# process (consumers running here) are put straight into their receive buffers, and
+# a group is stored in Redis as one member per process instead of one per channel:
+# 'group_send' delivers to the local members directly and only goes through Redis
+# for the other processes with members of the group.
+#
+# Groups matching 'local_groups' (prefixes) never have members in other processes
+# (e.g. rooms, see 'sharding'), so they don't use Redis at all. Without 'hosts' the
+# layer runs in a single process and every channel and group is local.
+#
+# 'send_many' sends a different message to each of several channels (e.g. the view of
+# the round of every player) with one Redis round trip per server.
+
+# KEYS: channel keys, ARGV: messages, capacities, time and expiry -> messages dropped
+LUA_SEND_MANY = """
+local count = #KEYS
+local now = ARGV[count * 2 + 1]
+local expiry = ARGV[count * 2 + 2]
+local dropped = 0
+for i = 1, count do
+    redis.call("ZREMRANGEBYSCORE", KEYS[i], 0, now - expiry)
+    if redis.call("ZCOUNT", KEYS[i], "-inf", "+inf") < tonumber(ARGV[count + i]) then
+        redis.call("ZADD", KEYS[i], now, ARGV[i])
+        redis.call("EXPIRE", KEYS[i], expiry)
+    else
+        dropped = dropped + 1
+    end
+end
+return dropped
+"""
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, local_groups=(), **kwargs):
+        super().__init__(hosts=hosts or None, **kwargs)
+        self.standalone = hosts is not None and not hosts
+        self.local_groups = tuple(local_groups)
+        # Members of every group in this process
+        self.groups = {}
+        # Group messages from other processes
+        self.inbox = f"hybrid.{self.client_prefix}!"
+        self.pumps = {}
+
+    def is_local_channel(self, channel):
+        if self.standalone:
+            return True
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    def is_local_group(self, group):
+        if self.standalone:
+            return True
+        return bool(self.local_groups) and group.startswith(self.local_groups)
+
+    def process_channel(self, group):
+        return self.inbox + group
+
+    # region Channels
+
+    async def send(self, channel, message):
+        if not self.is_local_channel(channel):
+            return await super().send(channel, message)
+
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+
+        buffer = self.receive_buffer[channel]
+        if buffer.qsize() >= self.get_capacity(channel):
+            raise ChannelFull()
+        buffer.put_nowait(dict(message))
+
+    async def receive(self, channel):
+        if not self.is_local_channel(channel):
+            return await super().receive(channel)
+
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if not self.standalone:
+            # Messages sent through Redis by other processes
+            self.start_pump(self.non_local_name(channel))
+
+        buffer = self.receive_buffer[channel]
+        try:
+            return await buffer.get()
+        finally:
+            if buffer.empty() and self.receive_buffer.get(channel) is buffer:
+                del self.receive_buffer[channel]
+
+    async def send_many(self, messages):
+        remote = collections.defaultdict(list)
+        for channel, message in messages.items():
+            if not self.is_local_channel(channel):
+                remote[self.consistent_hash(channel)].append((channel, message))
+                continue
+            buffer = self.receive_buffer[channel]
+            if buffer.qsize() >= self.get_capacity(channel):
+                print(f"EXCEPTION -> Channel '{channel}' is full.")
+                continue
+            buffer.put_nowait(dict(message))
+
+        for index, items in remote.items():
+            keys, values, capacities = [], [], []
+            for channel, message in items:
+                message = dict(message)
+                if "!" in channel:
+                    message["__asgi_channel__"] = channel
+                keys.append(self.prefix + self.non_local_name(channel))
+                values.append(self.serialize(message))
+                capacities.append(self.get_capacity(channel))
+
+            dropped = await self.connection(index).eval(
+                LUA_SEND_MANY,
+                len(keys),
+                *keys,
+                *values,
+                *capacities,
+                int(time.time()),
+                int(self.expiry),
+            )
+            if dropped:
+                print(f"EXCEPTION -> {dropped} messages dropped, channels are full.")
+
+    # endregion
+
+    # region Groups
+
+    async def group_add(self, group, channel):
+        if not self.is_local_channel(channel):
+            return await super().group_add(group, channel)
+
+        assert self.valid_group_name(group), "Group name not valid"
+        self.groups.setdefault(group, set()).add(channel)
+
+        if not self.is_local_group(group):
+            self.start_pump(self.inbox)
+            # Also refreshes the membership expiry of this process
+            await super().group_add(group, self.process_channel(group))
+
+    async def group_discard(self, group, channel):
+        if not self.is_local_channel(channel):
+            return await super().group_discard(group, channel)
+
+        members = self.groups.get(group)
+        if not members:
+            return
+
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            if not self.is_local_group(group):
+                await super().group_discard(group, self.process_channel(group))
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        self.deliver(group, message)
+
+        if self.is_local_group(group):
+            return
+
+        # Other processes (or channels of plain Redis layers) in the group
+        connection = self.connection(self.consistent_hash(group))
+        members = await connection.zrangebyscore(
+            self._group_key(group),
+            min=int(time.time()) - self.group_expiry,
+            max="+inf",
+        )
+
+        for member in members:
+            channel = member.decode("utf8")
+            if channel == self.process_channel(group):
+                continue
+            try:
+                await super().send(channel, message)
+            except ChannelFull:
+                print(f"EXCEPTION -> Channel '{channel}' of '{group}' is full.")
+
+    def deliver(self, group, message):
+        # Local members share one copy, as when a process receives it from Redis
+        members = self.groups.get(group)
+        if members:
+            message = dict(message)
+            for channel in members:
+                self.receive_buffer[channel].put_nowait(message)
+
+    # endregion
+
+    # region Redis receive
+
+    def start_pump(self, channel):
+        # One task per process-local Redis key moves its messages to the receive
+        # buffers, so local deliveries never wait for Redis
+        task = self.pumps.get(channel)
+        if task is None or task.done():
+            self.pumps[channel] = asyncio.get_running_loop().create_task(
+                self.pump(channel)
+            )
+
+    async def pump(self, channel):
+        while True:
+            try:
+                channels, message = await self.receive_single(channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("EXCEPTION -> Cannot receive messages from Redis.")
+                print(e)
+                await asyncio.sleep(1)
+                continue
+
+            if isinstance(channels, str):
+                channels = [channels]
+            for name in channels:
+                if name.startswith(self.inbox):
+                    self.deliver(name[len(self.inbox) :], message)
+                else:
+                    self.receive_buffer[name].put_nowait(message)
+
+    async def flush(self):
+        self.groups = {}
+        self.receive_buffer.clear()
+        if not self.standalone:
+            await super().flush()
+
+    async def close_pools(self):
+        for task in self.pumps.values():
+            task.cancel()
+        self.pumps = {}
+        if not self.standalone:
+            await super().close_pools()
+
+    # endregion
+
+
+async def send_many(channel_layer, messages):
+    # Other layers send the messages one by one
+    if isinstance(channel_layer, HybridChannelLayer):
+        return await channel_layer.send_many(messages)
+
+    for channel, message in messages.items():
+        try:
+            await channel_layer.send(channel, message)
+        except ChannelFull:
+            print(f"EXCEPTION -> Channel '{channel}' is full.")
@@ -1,6 +1,9 @@
 from enum import Enum
+import json
 import uuid
 
+import msgpack
+
 
 class State(str, Enum):
     LOBBY = "LOBBY"
@@ -10,13 +13,60 @@ class State(str, Enum):
 
 
 class WebsocketUser:
-    def __init__(self, username, captain):
+    # Single record of a player, shared by its consumer and its room. Every change
+    # increases 'version' and drops the cached wire encodings (JSON and MessagePack)
+    fields = ("username", "id", "captain", "outsider", "state", "guessWord")
+
+    __slots__ = fields + ("version", "_wire", "_packed")
+
+    def __init__(
+        self,
+        username,
+        captain,
+        id=None,
+        outsider=False,
+        state=State.LOBBY,
+        guessWord="",
+    ):
+        object.__setattr__(self, "version", 0)
+        object.__setattr__(self, "_wire", None)
+        object.__setattr__(self, "_packed", None)
         self.username = username
-        self.id = str(uuid.uuid4())
+        self.id = id or str(uuid.uuid4())
         self.captain = captain
-        self.outsider = False
-        self.state = State.LOBBY
-        self.guessWord = ""
+        self.outsider = outsider
+        self.state = State(state)
+        self.guessWord = guessWord
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "version", self.version + 1)
+        object.__setattr__(self, "_wire", None)
+        object.__setattr__(self, "_packed", None)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data[field] for field in cls.fields if field in data})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def roster_entry(self):
+        # The other players only know an outsider once it is out
+        data = self.to_dict()
+        if self.state != State.OUT:
+            data["outsider"] = False
+        return data
+
+    def to_wire(self):
+        if self._wire is None:
+            object.__setattr__(self, "_wire", json.dumps(self.roster_entry()))
+        return self._wire
+
+    def to_packed(self):
+        if self._packed is None:
+            object.__setattr__(self, "_packed", msgpack.packb(self.roster_entry()))
+        return self._packed
 
     def __str__(self):
         return f"{self.username}"
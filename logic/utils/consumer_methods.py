@@ -1,167 +1,54 @@
-import random
+from channels.layers import get_channel_layer
 
-from collections import Counter
-
-from .consumer_classes import State
-from . import sync_rest_calls
+from . import room_state, turns, voting, wire, word_lists
+from .channel_layer import send_many
 
 
 # WebSocket methods
 
 
-async def startGameLogic(self, restart=False):
-    if not self.word_list:
-        try:
-            self.word_list = await sync_rest_calls.get_word_list()
-        except Exception as e:
-            print("EXCEPTION -> There's no 'Current' word list.")
-            print(e)
-            return None
-
-    if restart:
-        self.db_room = await sync_rest_calls.get_room(room_name=self.room_name)
-        self.filtered_players = []
-        try:
-            self.selected_word = random.choice(
-                [
-                    word
-                    for word in self.word_list.word_list
-                    if word not in self.db_room.repeated_words
-                ]
-            )
-        except Exception as e:
-            print("EXCEPTION -> No more words to select, restarting...")
-            print(e)
-            self.selected_word = random.choice(self.word_list.word_list)
-            self.db_room.repeated_words = []
-
-    else:
-        self.selected_word = random.choice(self.word_list.word_list)
-        self.db_room.started_game = True
-        self.outsiders = await setOutsiders(
-            db_room=self.db_room, outsiders=self.outsiders
-        )
-
-    self.db_room.repeated_words.append(self.selected_word)
-
-    random.shuffle(self.db_room.current_connections)
-
-    player_turn = True
-    for player in self.db_room.current_connections:
-        if player["state"] == State.OUT:
-            continue
-
-        if player_turn:
-            player["state"] = State.PLAYER_TURN
-            self.first_player = player
-            player_turn = False
-        else:
-            player["state"] = State.PLAYING
-
-    await sync_rest_calls.update_room(self.db_room)
+async def startGameLogic(room, restart=False):
+    try:
+        word_list = await word_lists.get_word_list(name=room.word_list)
+    except Exception as e:
+        print(f"EXCEPTION -> There's no '{room.word_list}' word list.")
+        print(e)
+        return None
 
-    return self
+    voting.cancel_voting(room)
 
+    selected_word = room.draw_word(word_list, restart=restart)
 
-async def setOutsiders(db_room, outsiders):
-    if len(db_room.current_connections) >= 6:
-        db_room.number_outsiders = 2
+    if not restart:
+        room.set_outsiders()
 
-    if db_room.number_outsiders > 1:
-        k = db_room.number_outsiders
-        select_outsiders = random.sample(db_room.current_connections, k)
-        for outsider in select_outsiders:
-            outsiders.append(outsider["id"])
+    first_player = room.start_round(selected_word)
+    turns.start_turn(room, first_player)
 
-    else:
-        outsiders.append(random.choice(db_room.current_connections)["id"])
+    await room_state.save_room(room)
 
-    return outsiders
+    return room
 
 
 # RoomGroup methods
 
 
-async def startGameLogicRoomGroup(self, event):
-    self.votes = []
-
-    self.selected_word = event["message"]["selected_word"]
-
-    if self.user.id in self.outsiders:
-        self.user.outsider = True
-        key_word = "???"
-    else:
-        key_word = self.selected_word["a"]
-
-    turn_order = event["message"]["turn_order"]
-
-    if event["message"]["first_player"]["id"] == self.user.id:
-        self.user.state = State.PLAYER_TURN
-        # Only send the password if the outsider if the first player
-        if self.user.outsider:
-            key_word = self.selected_word["b"]
-    elif self.user.state != State.OUT:
-        self.user.state = State.PLAYING
-
-    return self, key_word, turn_order
-
-
-async def votingOutsider(self, player_vote):
-
-    self.votes.append(player_vote)
-
-    if not self.filtered_players:
-        self.filtered_players = [
-            player
-            for player in self.db_room.current_connections
-            if player["state"] == State.PLAYER_TURN or player["state"] == State.PLAYING
-        ]
+async def sendRoundViews(room, message_type):
+    # Each player sees the round differently (its word), so the views are prepared
+    # here once and sent together instead of each consumer working out its own
+    roster = wire.roster_event(room)
 
-    if len(self.votes) >= len(self.filtered_players):
-
-        counter = Counter(self.votes).most_common()
-        player_out = ""
-
-        if len(counter) > 1:
-            if counter[0][1] > counter[1][1]:
-                # If there's a most voted player
-                player_out = counter[0][0]
-        else:
-            player_out = counter[0][0]
-
-        current_playing = 0
-
-        next_captain = None
-
-        for player in self.db_room.current_connections:
-            if player["id"] == player_out:
-                player["state"] = State.OUT
-                player_out = player
-
-                if player_out["captain"]:
-                    for player in self.db_room.current_connections:
-                        if player["state"] != State.OUT:
-                            player["captain"] = True
-                            next_captain = player
-                            break
-
-                if player_out["id"] in self.outsiders:
-                    player_out["outsider"] = True
-
-            elif player["state"] != State.OUT:
-                current_playing = current_playing + 1
-
-        # Check if the players can continue playing without the eliminated player
-        if player_out and player_out["outsider"]:
-            self.db_room.number_outsiders -= 1
-
-        can_continue = (
-            current_playing > self.db_room.number_outsiders * 2
-            if self.db_room.number_outsiders > 0
-            else False
-        )
-
-        return self, False, player_out, can_continue, next_captain
-
-    else:
-        return self, True, None, False, None
+    messages = {}
+    for player in room.current_connections:
+        channel = room.channels.get(player.id)
+        if channel is None:
+            continue
+        messages[channel] = {
+            "type": "roundStart",
+            "message_type": message_type,
+            "key_word": room.key_word(player),
+            "user": wire.encode_nested(player),
+            **roster,
+        }
+
+    await send_many(get_channel_layer(), messages)
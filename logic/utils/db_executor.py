@@ -0,0 +1,104 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+# Thread pool for the ORM work without an async API (transactions, bulk updates...),
+# instead of the single thread shared by every 'sync_to_async' call. Jobs of the same
+# room run in the order they were submitted, jobs of different rooms run in parallel
+# in up to DB_EXECUTOR_WORKERS threads. At most DB_EXECUTOR_QUEUE jobs are queued or
+# running, further jobs wait before being queued (backpressure on the callers).
+
+
+class DatabaseExecutor:
+    def __init__(self, workers=4, max_queued=1000):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.pool = None
+        self.slots = asyncio.Semaphore(max_queued)
+        # Last job submitted for each room
+        self.tails = {}
+
+        # Metrics
+        self.queued = 0
+        self.running = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+
+    async def run(self, keys, function, *args):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="db")
+        loop = asyncio.get_running_loop()
+
+        # Chained after the previous jobs of the same rooms before any await
+        previous = [self.tails[key] for key in keys if key in self.tails]
+        done = loop.create_future()
+        for key in keys:
+            self.tails[key] = done
+
+        start = time.perf_counter()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        waiting = True
+        try:
+            async with self.slots:
+                for future in previous:
+                    await asyncio.shield(future)
+
+                waiting = False
+                self.queued -= 1
+                self.running += 1
+                self.wait_time += time.perf_counter() - start
+                try:
+                    return await loop.run_in_executor(
+                        self.pool, self.call, function, args
+                    )
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+                    self.completed += 1
+        finally:
+            if waiting:
+                self.queued -= 1
+            done.set_result(None)
+            for key in keys:
+                if self.tails.get(key) is done:
+                    del self.tails[key]
+
+    def call(self, function, args):
+        # Same connection handling as Channels' 'database_sync_to_async'
+        close_old_connections()
+        try:
+            return function(*args)
+        finally:
+            close_old_connections()
+
+    async def wait(self, key):
+        # Waits for the jobs already submitted for a room (e.g. before deleting it)
+        tail = self.tails.get(key)
+        if tail is not None:
+            await asyncio.shield(tail)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "peak_queued": self.peak_queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "mean_wait_ms": round(self.wait_time / (self.completed or 1) * 1000, 2),
+        }
+
+
+executor = DatabaseExecutor(
+    workers=getattr(settings, "DB_EXECUTOR_WORKERS", 4),
+    max_queued=getattr(settings, "DB_EXECUTOR_QUEUE", 1000),
+)
@@ -0,0 +1,79 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+# Deadlines of every room of the process (turns, votings...) in a single heap, served
+# by one task that sleeps until the earliest one. Scheduling the same kind of deadline
+# of a room again replaces the previous one, replaced and cancelled entries are skipped
+# when they reach the top.
+
+
+class DeadlineScheduler:
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.task = None
+        self.wakeup = asyncio.Event()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def schedule(self, room_name, kind, delay, callback):
+        self.start()
+        self.cancel(room_name, kind)
+
+        deadline = time.monotonic() + delay
+        entry = [deadline, next(self.counter), (room_name, kind), callback]
+        self.entries.setdefault(room_name, {})[kind] = entry
+        heapq.heappush(self.heap, entry)
+
+        # The task could be sleeping until a later deadline
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    def cancel(self, room_name, kind):
+        entries = self.entries.get(room_name)
+        if entries and kind in entries:
+            entries.pop(kind)[3] = None
+            if not entries:
+                del self.entries[room_name]
+
+    def cancel_room(self, room_name):
+        for entry in self.entries.pop(room_name, {}).values():
+            entry[3] = None
+
+    async def run(self):
+        while True:
+            # Drop the cancelled entries at the top
+            while self.heap and self.heap[0][3] is None:
+                heapq.heappop(self.heap)
+
+            timeout = None
+            if self.heap:
+                timeout = self.heap[0][0] - time.monotonic()
+
+            if timeout is None or timeout > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, _, (room_name, kind), callback = heapq.heappop(self.heap)
+            self.cancel(room_name, kind)
+            asyncio.create_task(self.expire(room_name, kind, callback))
+
+    async def expire(self, room_name, kind, callback):
+        try:
+            await callback()
+        except Exception as e:
+            print(f"EXCEPTION -> Deadline '{kind}' of room '{room_name}' failed.")
+            print(e)
+
+
+scheduler = DeadlineScheduler()
@@ -0,0 +1,45 @@
+from autobahn.websocket.compress import (
+    PerMessageDeflateOffer,
+    PerMessageDeflateOfferAccept,
+)
+from daphne.ws_protocol import WebSocketProtocol
+from django.conf import settings
+
+
+# WebSocket compression (permessage-deflate) of the Daphne server (see 'outsider.server').
+# Clients offering the extension get their frames compressed, except the ones shorter than
+# WEBSOCKET_DEFLATE_THRESHOLD bytes (pings, chat messages...), which are barely reduced and
+# would only cost CPU. The roster messages of a room repeat most of the previous one, so
+# with WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER the compressor of each connection keeps its
+# window between messages (better ratio, but its memory is kept for every connection).
+
+
+def accept_offer(offers):
+    if not getattr(settings, "WEBSOCKET_DEFLATE", True):
+        return None
+
+    context_takeover = getattr(settings, "WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER", True)
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(
+                offer,
+                # Client to server frames too, when the client supports it
+                request_no_context_takeover=not context_takeover
+                and offer.accept_no_context_takeover,
+                # None follows the client, it can ask for no context takeover
+                no_context_takeover=None if context_takeover else True,
+            )
+    return None
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    def sendMessage(self, payload, isBinary=False, *args, **kwargs):
+        if len(payload) < self.factory.deflate_threshold:
+            kwargs["doNotCompress"] = True
+        super().sendMessage(payload, isBinary, *args, **kwargs)
+
+
+def configure(factory):
+    factory.protocol = DeflateWebSocketProtocol
+    factory.deflate_threshold = getattr(settings, "WEBSOCKET_DEFLATE_THRESHOLD", 256)
+    factory.setProtocolOptions(perMessageCompressionAccept=accept_offer)
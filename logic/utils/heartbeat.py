@@ -0,0 +1,132 @@
+import asyncio
+import math
+import time
+
+from django.conf import settings
+
+
+# Idle detection of the room websockets. A client joining with "heartbeat": true is
+# sent {"message_type": "ping"} after HEARTBEAT_INTERVAL seconds without any message
+# from it, and is evicted if it doesn't send anything (e.g. {"action": "pong"}) in the
+# next HEARTBEAT_GRACE seconds. Eviction closes the websocket and the server's
+# disconnection goes through the consumer as usual, so the room sees a normal player
+# leave.
+#
+# Every socket of the process shares one timer wheel: a message only updates the
+# socket's last activity, and its deadline is checked again when its slot expires.
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.cursor = 0
+        self.deadlines = {}
+        self.callback = None
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def schedule(self, entry, deadline):
+        self.start()
+        self.deadlines[entry] = deadline
+
+        # Deadlines further than a turn of the wheel are checked again on that slot
+        ticks = math.ceil((deadline - time.monotonic()) / self.tick)
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        self.slots[(self.cursor + ticks) % len(self.slots)].add(entry)
+
+    def cancel(self, entry):
+        # The entry is dropped from its slot when the slot expires
+        self.deadlines.pop(entry, None)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            slot = self.slots[self.cursor]
+            self.slots[self.cursor] = set()
+
+            now = time.monotonic()
+            expired = []
+            for entry in slot:
+                deadline = self.deadlines.get(entry)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    self.schedule(entry, deadline)
+                else:
+                    del self.deadlines[entry]
+                    expired.append(entry)
+
+            if expired:
+                results = await asyncio.gather(
+                    *(self.callback(entry) for entry in expired),
+                    return_exceptions=True,
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        print("EXCEPTION -> Heartbeat check failed.")
+                        print(result)
+
+
+class Heartbeat:
+    def __init__(self):
+        self.wheel = TimerWheel()
+        self.wheel.callback = self.expire
+        self.last_seen = {}
+        self.pinged = set()
+
+    def interval(self):
+        return getattr(settings, "HEARTBEAT_INTERVAL", 20)
+
+    def grace(self):
+        return getattr(settings, "HEARTBEAT_GRACE", 10)
+
+    def watch(self, consumer):
+        # The tick is read like the other settings, the wheel and its sockets are kept
+        # (deadlines are checked again when their slot expires)
+        self.wheel.tick = getattr(settings, "HEARTBEAT_TICK", 1)
+        self.last_seen[consumer] = time.monotonic()
+        self.wheel.schedule(consumer, self.last_seen[consumer] + self.interval())
+
+    def unwatch(self, consumer):
+        if self.last_seen.pop(consumer, None) is not None:
+            self.pinged.discard(consumer)
+            self.wheel.cancel(consumer)
+
+    def touch(self, consumer):
+        if consumer in self.last_seen:
+            self.last_seen[consumer] = time.monotonic()
+            self.pinged.discard(consumer)
+
+    async def expire(self, consumer):
+        last_seen = self.last_seen.get(consumer)
+        if last_seen is None:
+            return
+
+        now = time.monotonic()
+        if now - last_seen < self.interval():
+            self.wheel.schedule(consumer, last_seen + self.interval())
+
+        elif consumer not in self.pinged:
+            self.pinged.add(consumer)
+            self.wheel.schedule(consumer, now + self.grace())
+            await consumer.send_json(content={"message_type": "ping"})
+
+        else:
+            self.unwatch(consumer)
+            await self.evict(consumer)
+
+    async def evict(self, consumer):
+        print(
+            f"Evicting idle connection of '{consumer.user}' in '{consumer.room_name}'"
+        )
+        # The server answers the close with 'websocket.disconnect' (also when the client
+        # doesn't complete the closing handshake), handled by the consumer as usual
+        await consumer.close(code=4008)
+
+
+heartbeat = Heartbeat()
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from ..models import RoomModel
+from . import room_state
+
+
+# Room leases. The worker playing a room records itself as its owner and renews the
+# lease of all its active rooms every ROOM_LEASE_RENEW seconds. A room whose lease
+# expired has no worker left (it crashed, or the room was created and never joined or
+# left empty), so any worker deletes it, ROOM_REAPER_BATCH rooms at a time. The table
+# stays small without deleting every room when a worker starts.
+
+worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_ttl():
+    return timedelta(seconds=getattr(settings, "ROOM_LEASE_TTL", 60))
+
+
+async def renew(names=None):
+    # One UPDATE for every active room of the process
+    if names is None:
+        names = list(room_state.rooms)
+    if not names:
+        return 0
+    return await RoomModel.objects.filter(name__in=names).aupdate(
+        owner=worker_id, lease_expires=timezone.now() + lease_ttl()
+    )
+
+
+async def claim(room_name):
+    # When the process starts playing a room, its lease could be about to expire
+    await renew([room_name])
+
+
+async def reap(batch_size=None):
+    if batch_size is None:
+        batch_size = getattr(settings, "ROOM_REAPER_BATCH", 100)
+
+    now = timezone.now()
+    expired = RoomModel.objects.filter(lease_expires__lt=now).exclude(
+        name__in=list(room_state.rooms)
+    )
+    pks = [pk async for pk in expired.values_list("pk", flat=True)[:batch_size]]
+    if not pks:
+        return 0
+
+    # Checked again, the lease could have been renewed meanwhile
+    deleted, _ = await RoomModel.objects.filter(
+        pk__in=pks, lease_expires__lt=now
+    ).adelete()
+    return deleted
+
+
+class LeaseKeeper:
+    def __init__(self):
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await renew()
+                # A full batch leaves more expired rooms, the next one goes right away
+                batch_size = getattr(settings, "ROOM_REAPER_BATCH", 100)
+                while await reap(batch_size) >= batch_size:
+                    await asyncio.sleep(0)
+            except Exception as e:
+                print("EXCEPTION -> Cannot renew the room leases.")
+                print(e)
+
+            await asyncio.sleep(getattr(settings, "ROOM_LEASE_RENEW", 15))
+
+
+keeper = LeaseKeeper()
@@ -0,0 +1,64 @@
+import asyncio
+
+from django.conf import settings
+
+from . import leases, room_persistence, room_state, sharding, word_lists
+
+
+# Start and graceful shutdown of a worker process (see 'outsider.server'). On start the
+# worker only fills its caches, starts keeping the leases of its rooms (see 'leases')
+# and listening for the websockets relayed by the other workers (see 'sharding'), the
+# database is prepared once per deploy ('python manage.py bootstrap').
+# Once draining, the worker stops accepting websockets but keeps serving its rooms
+# until they finish or the grace period ends, and then writes every pending room
+# update.
+
+warmed_up = False
+draining = False
+
+
+async def warmup():
+    # Idempotent, it can run again (e.g. if the database wasn't ready)
+    global warmed_up
+
+    leases.keeper.start()
+    if sharding.number_of_shards() > 1:
+        sharding.listener.start()
+
+    if warmed_up:
+        return
+
+    try:
+        await word_lists.get_word_list(name="Current")
+    except Exception as e:
+        print("EXCEPTION -> Cannot load the 'Current' word list (manage.py bootstrap).")
+        print(e)
+        return
+
+    warmed_up = True
+
+
+def start_draining():
+    global draining
+    draining = True
+
+
+async def drain(grace=None):
+    start_draining()
+
+    if grace is None:
+        grace = getattr(settings, "SHUTDOWN_GRACE", 30)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + grace
+    while room_state.rooms and loop.time() < deadline:
+        await asyncio.sleep(0.5)
+
+    if room_state.rooms:
+        print(f"Shutting down with {len(room_state.rooms)} active rooms...")
+
+    try:
+        await room_persistence.flush()
+    except Exception as e:
+        print("EXCEPTION -> Cannot persist rooms state on shutdown.")
+        print(e)
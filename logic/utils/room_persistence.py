@@ -0,0 +1,149 @@
+import asyncio
+
+from django.conf import settings
+from django.db import connection
+
+from . import sync_rest_calls
+
+
+# Write-behind queue for 'RoomModel' snapshots. Updates of the same room inside
+# the durability window are coalesced into a single UPDATE of the changed
+# fields, and the queue is flushed in batches.
+#
+# On PostgreSQL only the players that changed since the last write are written
+# ('players_patch'): they replace their entries by id and the new players are appended
+# to the JSONB array. Leaving players or a new turn order rewrite the whole array.
+
+
+def players_patch(room):
+    # -> (changed players by id, joined players) or None to write every player
+    order = room.stored_order
+    if order is None or len(order) > len(room.current_connections):
+        return None
+    if [player.id for player in room.current_connections[: len(order)]] != order:
+        return None
+
+    changed = {
+        player.id: player.to_dict()
+        for player in room.current_connections[: len(order)]
+        if room.stored_versions.get(player.id) != player.version
+    }
+    joined = [player.to_dict() for player in room.current_connections[len(order) :]]
+    return changed, joined
+
+
+def written(room):
+    room.stored_versions = {
+        player.id: player.version for player in room.current_connections
+    }
+    room.stored_order = [player.id for player in room.current_connections]
+
+
+class RoomWriteQueue:
+    def __init__(self, window=0.05, batch_size=100):
+        self.window = window
+        self.batch_size = batch_size
+        self.pending = {}
+        # Rooms of the batch being written, unless deleted meanwhile
+        self.writing = set()
+        self.lock = asyncio.Lock()
+        self.task = None
+        # JSONB partial updates of the players (PostgreSQL)
+        self.partial = connection.vendor == "postgresql"
+
+    def enqueue(self, room, fields):
+        if not fields:
+            return
+
+        pending = self.pending.get(room.name)
+        if pending and pending[0] is room:
+            pending[1].update(fields)
+        else:
+            self.pending[room.name] = (room, set(fields))
+
+        if self.window > 0 and self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def discard(self, room_name):
+        self.pending.pop(room_name, None)
+        self.writing.discard(room_name)
+
+    async def run(self):
+        try:
+            while self.pending:
+                await asyncio.sleep(self.window)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print("EXCEPTION -> Cannot persist rooms state.")
+                    print(e)
+        finally:
+            self.task = None
+
+    async def flush(self, room_name=None):
+        # The lock also waits for an in-flight batch of the requested room
+        async with self.lock:
+            while self.pending:
+                if room_name is not None:
+                    if room_name not in self.pending:
+                        return
+                    names = [room_name]
+                else:
+                    names = list(self.pending)[: self.batch_size]
+
+                batch = []
+                entries = []
+                for name in names:
+                    room, fields = self.pending.pop(name)
+                    entries.append((room, set(fields)))
+                    patch = None
+                    if "current_connections" in fields:
+                        if self.partial:
+                            patch = players_patch(room)
+                        if patch is not None:
+                            fields.discard("current_connections")
+                        written(room)
+                    batch.append((name, room.snapshot(fields), patch))
+
+                self.writing = set(names)
+                try:
+                    await sync_rest_calls.update_rooms_state(batch)
+                except:
+                    self.retry(entries)
+                    raise
+                finally:
+                    self.writing = set()
+
+    def retry(self, entries):
+        # The fields of a failed batch are pending again (with the ones changed
+        # meanwhile), and the players in the database are unknown so the next write
+        # has them all
+        for room, fields in entries:
+            room.stored_order = None
+            if room.name not in self.writing:
+                continue
+            pending = self.pending.get(room.name)
+            if pending is None:
+                self.pending[room.name] = (room, fields)
+            elif pending[0] is room:
+                pending[1].update(fields)
+
+
+queue = RoomWriteQueue(
+    window=getattr(settings, "ROOM_PERSISTENCE_WINDOW", 0.05),
+    batch_size=getattr(settings, "ROOM_PERSISTENCE_BATCH_SIZE", 100),
+)
+
+
+async def save(room, fields):
+    queue.enqueue(room, fields)
+    if queue.window <= 0:
+        await queue.flush(room.name)
+
+
+async def flush(room_name=None):
+    await queue.flush(room_name)
+
+
+def discard(room_name):
+    queue.discard(room_name)
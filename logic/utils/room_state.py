@@ -0,0 +1,350 @@
+import random
+
+from .consumer_classes import State, WebsocketUser
+from . import leases, room_store
+from .deadlines import scheduler
+from .word_lists import WordBag
+
+
+# In-process authoritative state of every active room, shared with the other workers
+# through the room store (see 'room_store').
+
+PERSISTED_FIELDS = (
+    "current_connections",
+    "number_outsiders",
+    "repeated_words",
+    "started_game",
+)
+
+
+class Room:
+    def __init__(
+        self,
+        name,
+        current_connections=None,
+        number_outsiders=1,
+        repeated_words=None,
+        started_game=False,
+        word_list="Current",
+    ):
+        self.name = name
+        self.group_name = f"room_{name}"
+        self.current_connections = [
+            WebsocketUser.from_dict(player) for player in current_connections or []
+        ]
+        self.players = {player.id: player for player in self.current_connections}
+
+        # Roster versions last sent to the room group (see 'roster_delta')
+        self.roster_seq = 0
+        self.published = {}
+        self.published_order = []
+        self.number_outsiders = number_outsiders
+        self.repeated_words = repeated_words or []
+        self.started_game = started_game
+        self.word_list = word_list
+
+        # Persisted fields changed since the last save
+        self.changed = set()
+        # Player versions and turn order already written to the room store
+        self.stored_versions = {}
+        self.stored_order = None
+        # Channel of the consumer of each player (rooms are played by one process),
+        # number of open consumers of the room (with or without a player) and of the
+        # ones using the binary protocol (see 'wire')
+        self.channels = {}
+        self.sockets = 0
+        self.binary_clients = 0
+
+        # Round state (not persisted)
+        self.outsiders = []
+        self.selected_word = None
+        self.first_player = None
+        self.voting = None
+        self.word_bag = None
+        # Players in the game when the round started, in turn order, and the position
+        # of the player with the turn
+        self.turn_order = []
+        self.turn = 0
+
+    @property
+    def phase(self):
+        # "lobby" until the first round starts, then "game" (see 'actions')
+        return "game" if self.started_game else "lobby"
+
+    def mark_changed(self, *fields):
+        self.changed.update(fields)
+
+    def snapshot(self, fields=PERSISTED_FIELDS):
+        # Copies, so the room can keep changing while the snapshot is written
+        snapshot = {}
+        for field in fields:
+            value = getattr(self, field)
+            if field == "current_connections":
+                value = [player.to_dict() for player in value]
+            elif field == "repeated_words":
+                value = list(value)
+            snapshot[field] = value
+        return snapshot
+
+    def get_player(self, player_id):
+        return self.players.get(player_id)
+
+    def roster_delta(self):
+        # Changes of the roster since the last call, tagged with a new sequence number.
+        # Every operation carries the whole player entry so applying it is idempotent
+        ops = []
+        joined = []
+        for player in self.current_connections:
+            version = self.published.get(player.id)
+            if version is None:
+                ops.append(("join", player))
+                joined.append(player.id)
+            elif version != player.version:
+                ops.append(("update", player))
+
+        for player_id in self.published:
+            if player_id not in self.players:
+                ops.append(("leave", player_id))
+
+        order = [player.id for player in self.current_connections]
+        expected = [id for id in self.published_order if id in self.players] + joined
+        if order != expected:
+            ops.append(("order", order))
+
+        self.published = {
+            player.id: player.version for player in self.current_connections
+        }
+        self.published_order = order
+
+        if ops:
+            self.roster_seq += 1
+        return self.roster_seq, ops
+
+    # region Typed operations
+
+    def add_player(self, username):
+        user = WebsocketUser(username=username, captain=not self.current_connections)
+        self.current_connections.append(user)
+        self.players[user.id] = user
+        self.mark_changed("current_connections")
+        return user
+
+    def remove_player(self, user):
+        if self.players.pop(user.id, None) is None:
+            return None
+        self.current_connections.remove(user)
+        self.mark_changed("current_connections")
+
+        next_captain = None
+        if self.current_connections:
+            if user.captain:
+                next_captain = self.move_captain()
+
+            if user.outsider:
+                self.number_outsiders -= 1
+                self.mark_changed("number_outsiders")
+
+        return next_captain
+
+    def reclaim(self):
+        self.current_connections = []
+        self.players = {}
+        self.started_game = False
+        self.number_outsiders = 1
+        self.mark_changed("current_connections", "started_game", "number_outsiders")
+
+    def move_captain(self):
+        for player in self.current_connections:
+            if player.state != State.OUT:
+                player.captain = True
+                self.mark_changed("current_connections")
+                return player
+        return None
+
+    def set_outsiders(self):
+        if len(self.current_connections) >= 6:
+            self.number_outsiders = 2
+            self.mark_changed("number_outsiders")
+
+        k = self.number_outsiders if self.number_outsiders > 1 else 1
+        self.outsiders = []
+        for player in random.sample(self.current_connections, k):
+            player.outsider = True
+            self.outsiders.append(player.id)
+        return self.outsiders
+
+    def draw_word(self, word_list, restart=True):
+        if (
+            not restart
+            or self.word_bag is None
+            or self.word_bag.word_list is not word_list
+        ):
+            self.word_bag = WordBag(word_list, used=self.repeated_words)
+
+        word = self.word_bag.draw()
+        if word is None:
+            print("No more words to select, restarting...")
+            self.repeated_words = []
+            self.word_bag = WordBag(word_list)
+            word = self.word_bag.draw()
+
+        return word
+
+    def start_round(self, selected_word):
+        self.started_game = True
+        self.selected_word = selected_word
+        self.repeated_words.append(selected_word)
+        self.mark_changed("started_game", "repeated_words", "current_connections")
+
+        random.shuffle(self.current_connections)
+
+        self.turn_order = [
+            player for player in self.current_connections if player.state != State.OUT
+        ]
+        self.turn = 0
+        for player in self.turn_order:
+            player.state = State.PLAYING
+
+        self.first_player = self.current_turn()
+        if self.first_player is not None:
+            self.first_player.state = State.PLAYER_TURN
+
+        return self.first_player
+
+    def key_word(self, player):
+        # What each player is told of the word: outsiders don't know it, unless the
+        # outsider starts the round, then it gets a related one
+        if player.outsider:
+            if self.first_player is not None and player.id == self.first_player.id:
+                return self.selected_word["b"]
+            return "???"
+        return self.selected_word["a"]
+
+    def current_turn(self):
+        if self.turn < len(self.turn_order):
+            return self.turn_order[self.turn]
+        return None
+
+    def next_turn(self, player, guess_word=None):
+        # Ends the turn of 'player' (the current one) and gives it to the next player,
+        # None once every player of the round has played
+        if guess_word is not None:
+            player.guessWord = guess_word
+        player.state = State.PLAYING
+        self.mark_changed("current_connections")
+
+        self.turn += 1
+        while self.turn < len(self.turn_order):
+            next_player = self.turn_order[self.turn]
+            # Players that left or are out since the round started are skipped
+            if (
+                self.players.get(next_player.id) is next_player
+                and next_player.state != State.OUT
+            ):
+                next_player.state = State.PLAYER_TURN
+                return next_player
+            self.turn += 1
+        return None
+
+    def eliminate(self, player_id):
+        player_out = ""
+        next_captain = None
+        current_playing = 0
+
+        for player in self.current_connections:
+            if player.id == player_id:
+                player.state = State.OUT
+                player_out = player
+            elif player.state != State.OUT:
+                current_playing += 1
+
+        if player_out:
+            if player_out.captain:
+                player_out.captain = False
+                next_captain = self.move_captain()
+
+            if player_out.outsider:
+                self.number_outsiders -= 1
+
+        self.mark_changed("current_connections", "number_outsiders")
+
+        return player_out, next_captain, current_playing
+
+    # endregion
+
+
+rooms = {}
+
+
+async def get_room(room_name):
+    room = rooms.get(room_name)
+    if room is None:
+        state = await room_store.get_store().load(room_name)
+        # Another consumer could have loaded the room meanwhile
+        room = rooms.get(room_name)
+        if room is None:
+            room = rooms[room_name] = Room(room_name, **state)
+            await leases.claim(room_name)
+            if room.current_connections:
+                await reclaim_room(room)
+    return room
+
+
+async def reclaim_room(room):
+    # The room is played by this process (see 'sharding') but wasn't active, so its
+    # players were connected to a previous process (e.g. it crashed or was restarted)
+    # and their websockets are gone. It's reclaimed as an empty lobby
+    print(f"Reclaiming orphaned room '{room.name}'...")
+    room.reclaim()
+    await save_room(room)
+
+
+def release_room(room):
+    # Rooms without players are only kept in memory while a socket uses them
+    if (
+        not room.current_connections
+        and not room.sockets
+        and rooms.get(room.name) is room
+    ):
+        rooms.pop(room.name)
+
+
+async def save_room(room):
+    if rooms.get(room.name) is not room:
+        return
+    fields, room.changed = room.changed, set()
+    await room_store.get_store().save(room, fields)
+
+
+async def delete_room(room_name):
+    rooms.pop(room_name, None)
+    scheduler.cancel_room(room_name)
+    await room_store.get_store().delete(room_name)
+
+
+# region Shared operations (the room store decides the result for every worker)
+
+
+async def join_room(room, username, channel_name=None):
+    user = room.add_player(username)
+    if channel_name:
+        room.channels[user.id] = channel_name
+    return await room_store.get_store().join(room, user)
+
+
+async def leave_room(room, user):
+    if room.get_player(user.id) is None:
+        return None
+    room.channels.pop(user.id, None)
+    next_captain = room.remove_player(user)
+    return await room_store.get_store().leave(room, user, next_captain)
+
+
+async def eliminate_player(room, player_id):
+    player_out, next_captain, current_playing = room.eliminate(player_id)
+    return await room_store.get_store().eliminate(
+        room, player_out, next_captain, current_playing
+    )
+
+
+# endregion
@@ -0,0 +1,402 @@
+import json
+
+import redis
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from redis import asyncio as aioredis
+
+from ..models import RoomModel
+from . import room_persistence, sync_rest_calls
+
+
+# Shared state of the active rooms (ROOM_STORE). The in-process 'Room' of the worker
+# playing a room is always up to date, the store is where that state is shared:
+#  - "database": snapshots written behind to 'RoomModel' (see 'room_persistence')
+#  - "redis": a hash per room with its fields, the player ids in turn order ("order")
+#    and one "player:<id>" entry per player. Operations that depend on the rest of the
+#    room (join, leave and eliminate, with the captain handover and the outsiders
+#    decrement) run as Lua scripts, atomic for every worker without locks, and their
+#    results are applied to the local room. 'RoomModel' only records the room exists,
+#    a room is removed from Redis when its row is created or deleted
+
+STATE_FIELDS = (
+    "current_connections",
+    "number_outsiders",
+    "repeated_words",
+    "started_game",
+    "word_list",
+)
+
+
+def can_continue(room, current_playing):
+    # The outsiders can't win yet if there're more than twice the players left
+    if room.number_outsiders <= 0:
+        return False
+    return current_playing > room.number_outsiders * 2
+
+
+class DatabaseRoomStore:
+    async def load(self, room_name):
+        db_room = await sync_rest_calls.get_room(room_name=room_name)
+        return {field: getattr(db_room, field) for field in STATE_FIELDS}
+
+    async def save(self, room, fields):
+        await room_persistence.save(room, fields)
+
+    async def delete(self, room_name):
+        room_persistence.discard(room_name)
+        await sync_rest_calls.delete_room(room_name=room_name)
+
+    async def join(self, room, user):
+        return user
+
+    async def leave(self, room, user, next_captain):
+        return next_captain
+
+    async def eliminate(self, room, player_out, next_captain, current_playing):
+        return player_out, next_captain, can_continue(room, current_playing)
+
+
+# region Redis scripts
+
+LUA_PLAYERS = """
+local function load_order()
+    return cjson.decode(redis.call("HGET", KEYS[1], "order") or "[]")
+end
+
+local function save_order(order)
+    -- cjson encodes an empty table as an object
+    local encoded = "[]"
+    if #order > 0 then
+        encoded = cjson.encode(order)
+    end
+    redis.call("HSET", KEYS[1], "order", encoded)
+end
+
+local function get_player(id)
+    local data = redis.call("HGET", KEYS[1], "player:" .. id)
+    return data and cjson.decode(data)
+end
+
+local function set_player(player)
+    redis.call("HSET", KEYS[1], "player:" .. player.id, cjson.encode(player))
+end
+
+-- The first player still in the game becomes the captain
+local function move_captain(order)
+    for _, id in ipairs(order) do
+        local player = get_player(id)
+        if player.state ~= "OUT" then
+            player.captain = true
+            set_player(player)
+            return id
+        end
+    end
+    return ""
+end
+"""
+
+# ARGV: expiry, field/value pairs of the room
+LUA_INIT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+return redis.call("HGETALL", KEYS[1])
+"""
+
+# ARGV: player -> captain (0/1)
+LUA_JOIN = (
+    LUA_PLAYERS
+    + """
+local player = cjson.decode(ARGV[1])
+local order = load_order()
+player.captain = #order == 0
+table.insert(order, player.id)
+save_order(order)
+set_player(player)
+if player.captain then
+    return 1
+end
+return 0
+"""
+)
+
+# ARGV: player id -> {next captain id, number of outsiders}
+LUA_LEAVE = (
+    LUA_PLAYERS
+    + """
+local player = get_player(ARGV[1])
+if not player then
+    return false
+end
+redis.call("HDEL", KEYS[1], "player:" .. ARGV[1])
+
+local order = load_order()
+for i, id in ipairs(order) do
+    if id == ARGV[1] then
+        table.remove(order, i)
+        break
+    end
+end
+save_order(order)
+
+local next_captain = ""
+if #order > 0 then
+    if player.captain then
+        next_captain = move_captain(order)
+    end
+    if player.outsider then
+        redis.call("HINCRBY", KEYS[1], "number_outsiders", -1)
+    end
+end
+return {next_captain, tonumber(redis.call("HGET", KEYS[1], "number_outsiders"))}
+"""
+)
+
+# ARGV: player id -> {next captain id, number of outsiders, players still playing}
+LUA_ELIMINATE = (
+    LUA_PLAYERS
+    + """
+local order = load_order()
+local player_out = false
+local playing = 0
+for _, id in ipairs(order) do
+    local player = get_player(id)
+    if id == ARGV[1] then
+        player_out = player
+    elseif player.state ~= "OUT" then
+        playing = playing + 1
+    end
+end
+
+local next_captain = ""
+if player_out then
+    local captain = player_out.captain
+    player_out.state = "OUT"
+    player_out.captain = false
+    set_player(player_out)
+    if captain then
+        next_captain = move_captain(order)
+    end
+    if player_out.outsider then
+        redis.call("HINCRBY", KEYS[1], "number_outsiders", -1)
+    end
+end
+return {
+    next_captain,
+    tonumber(redis.call("HGET", KEYS[1], "number_outsiders")),
+    playing,
+}
+"""
+)
+
+# ARGV: expiry, field/value pairs of the room. A new order also removes the entries of
+# the players left out of it (e.g. the roster of a reclaimed room)
+LUA_SAVE = """
+redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+
+for i = 2, #ARGV, 2 do
+    if ARGV[i] == "order" then
+        local kept = {}
+        for _, id in ipairs(cjson.decode(ARGV[i + 1])) do
+            kept["player:" .. id] = true
+        end
+        for _, field in ipairs(redis.call("HKEYS", KEYS[1])) do
+            if string.sub(field, 1, 7) == "player:" and not kept[field] then
+                redis.call("HDEL", KEYS[1], field)
+            end
+        end
+        break
+    end
+end
+"""
+
+SCRIPTS = {
+    "init": LUA_INIT,
+    "save": LUA_SAVE,
+    "join": LUA_JOIN,
+    "leave": LUA_LEAVE,
+    "eliminate": LUA_ELIMINATE,
+}
+
+# endregion
+
+
+class RedisRoomStore:
+    def __init__(self):
+        self.redis = None
+        self.sync_redis = None
+        self.scripts = {}
+
+    def key(self, room_name):
+        return f"outsider:room:{room_name}"
+
+    def connect(self):
+        if self.redis is None:
+            self.redis = aioredis.from_url(
+                settings.REDIS_HOSTS[0], decode_responses=True
+            )
+            self.scripts = {
+                name: self.redis.register_script(source)
+                for name, source in SCRIPTS.items()
+            }
+
+    async def run(self, script, room_name, *args):
+        self.connect()
+        return await self.scripts[script](keys=[self.key(room_name)], args=args)
+
+    # region Encoding
+
+    def encode_fields(self, state):
+        encoded = {}
+        for field, value in state.items():
+            if field == "current_connections":
+                for player in value:
+                    encoded[f"player:{player['id']}"] = json.dumps(player)
+                encoded["order"] = json.dumps([player["id"] for player in value])
+            elif field == "started_game":
+                encoded[field] = int(value)
+            elif field == "repeated_words":
+                encoded[field] = json.dumps(value)
+            else:
+                encoded[field] = value
+        return encoded
+
+    def decode_fields(self, data):
+        return {
+            "current_connections": [
+                json.loads(data[f"player:{id}"]) for id in json.loads(data["order"])
+            ],
+            "number_outsiders": int(data["number_outsiders"]),
+            "repeated_words": json.loads(data["repeated_words"]),
+            "started_game": data["started_game"] == "1",
+            "word_list": data["word_list"],
+        }
+
+    def written(self, room, *players):
+        # Players already up to date in Redis, 'save' skips them
+        for player in players:
+            if player is not None:
+                room.stored_versions[player.id] = player.version
+        room.stored_order = [player.id for player in room.current_connections]
+
+    # endregion
+
+    async def load(self, room_name):
+        self.connect()
+        data = await self.redis.hgetall(self.key(room_name))
+
+        if not data:
+            # First worker using the room since it was created
+            state = await DatabaseRoomStore().load(room_name)
+            encoded = self.encode_fields(state)
+            values = [value for pair in encoded.items() for value in pair]
+            reply = await self.run("init", room_name, settings.ROOM_STORE_TTL, *values)
+            data = dict(zip(reply[::2], reply[1::2]))
+
+        return self.decode_fields(data)
+
+    async def save(self, room, fields):
+        mapping = self.encode_fields(
+            room.snapshot([field for field in fields if field != "current_connections"])
+        )
+
+        if "current_connections" in fields:
+            for player in room.current_connections:
+                if room.stored_versions.get(player.id) != player.version:
+                    mapping[f"player:{player.id}"] = json.dumps(player.to_dict())
+            order = [player.id for player in room.current_connections]
+            if order != room.stored_order:
+                mapping["order"] = json.dumps(order)
+            self.written(room, *room.current_connections)
+
+        if not mapping:
+            return
+
+        values = [value for pair in mapping.items() for value in pair]
+        await self.run("save", room.name, settings.ROOM_STORE_TTL, *values)
+
+    async def delete(self, room_name):
+        self.connect()
+        await self.redis.delete(self.key(room_name))
+        await sync_rest_calls.delete_room(room_name=room_name)
+
+    def clear(self, room_name):
+        # From the synchronous code saving and deleting 'RoomModel'
+        if self.sync_redis is None:
+            self.sync_redis = redis.Redis.from_url(settings.REDIS_HOSTS[0])
+        self.sync_redis.delete(self.key(room_name))
+
+    # region Atomic operations
+
+    async def join(self, room, user):
+        captain = await self.run("join", room.name, json.dumps(user.to_dict()))
+        # Another worker could have added the first player meanwhile
+        if user.captain != bool(captain):
+            user.captain = bool(captain)
+        self.written(room, user)
+        return user
+
+    async def leave(self, room, user, next_captain):
+        result = await self.run("leave", room.name, user.id)
+        if not result:
+            room.stored_versions.pop(user.id, None)
+            return next_captain
+
+        captain_id, number_outsiders = result
+        next_captain = self.handover(room, next_captain, captain_id)
+        room.number_outsiders = number_outsiders
+        room.stored_versions.pop(user.id, None)
+        self.written(room, next_captain)
+        return next_captain
+
+    async def eliminate(self, room, player_out, next_captain, current_playing):
+        player_id = player_out.id if player_out else ""
+        captain_id, number_outsiders, current_playing = await self.run(
+            "eliminate", room.name, player_id
+        )
+
+        next_captain = self.handover(room, next_captain, captain_id)
+        room.number_outsiders = number_outsiders
+        self.written(room, player_out or None, next_captain)
+        return player_out, next_captain, can_continue(room, current_playing)
+
+    def handover(self, room, next_captain, captain_id):
+        # Redis decides the new captain, the local room could have picked another one
+        if next_captain is not None and next_captain.id != captain_id:
+            next_captain.captain = False
+        next_captain = room.get_player(captain_id) if captain_id else None
+        if next_captain is not None and not next_captain.captain:
+            next_captain.captain = True
+        return next_captain
+
+    # endregion
+
+
+stores = {"database": DatabaseRoomStore(), "redis": RedisRoomStore()}
+
+
+def get_store():
+    return stores[getattr(settings, "ROOM_STORE", "database")]
+
+
+def clear_redis_room(room_name):
+    if get_store() is stores["redis"]:
+        stores["redis"].clear(room_name)
+
+
+# A new room never gets the state left in Redis by a previous one with the same name
+# (e.g. by a crashed worker), and a room deleted from the database is gone for every worker
+@receiver(post_save, sender=RoomModel)
+def clear_created_room(sender, instance, created, **kwargs):
+    if created:
+        clear_redis_room(instance.name)
+
+
+@receiver(post_delete, sender=RoomModel)
+def clear_deleted_room(sender, instance, **kwargs):
+    clear_redis_room(instance.name)
@@ -0,0 +1,124 @@
+import asyncio
+import zlib
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+
+# Room affinity between ASGI workers. Every room name is hashed to a shard (worker)
+# that keeps its authoritative state and runs its game logic. Websockets accepted by
+# another worker are tunneled to the owner over the channel layer: the owner runs the
+# room consumer for them and the accepting worker only relays the websocket messages.
+
+# Scope keys that can be sent through the channel layer
+FORWARDED_SCOPE = (
+    "type",
+    "path",
+    "query_string",
+    "headers",
+    "subprotocols",
+    "client",
+    "url_route",
+)
+
+
+def number_of_shards():
+    return getattr(settings, "ROOM_SHARDS", 1)
+
+
+def local_shard():
+    return getattr(settings, "ROOM_SHARD", 0)
+
+
+def shard_for(room_name):
+    # crc32 instead of hash(), which changes between processes
+    return zlib.crc32(room_name.encode()) % number_of_shards()
+
+
+def is_local(room_name):
+    return number_of_shards() <= 1 or shard_for(room_name) == local_shard()
+
+
+def shard_channel(shard):
+    return f"room-shard.{shard}"
+
+
+def forward_scope(scope):
+    return {key: scope[key] for key in FORWARDED_SCOPE if key in scope}
+
+
+class Tunnel:
+    # ASGI transport of a websocket accepted by another worker
+    def __init__(self, relay):
+        self.relay = relay
+        self.queue = asyncio.Queue()
+
+    async def receive(self):
+        return await self.queue.get()
+
+    async def send(self, message):
+        await get_channel_layer().send(
+            self.relay, {"type": "relay.send", "message": message}
+        )
+
+
+class ShardListener:
+    # Started with the worker (see 'lifecycle.warmup'), the relays of the other workers
+    # can send their websockets before this one accepts any
+    def __init__(self):
+        self.app = None
+        self.task = None
+        self.tunnels = {}
+
+    def start(self, app=None, shard=None):
+        if self.task is not None and not self.task.done():
+            return
+
+        self.tunnels = {}
+        self.task = asyncio.get_running_loop().create_task(
+            self.listen(app or self.app, local_shard() if shard is None else shard)
+        )
+
+    async def listen(self, app, shard):
+        channel_layer = get_channel_layer()
+        channel = shard_channel(shard)
+
+        while True:
+            message = await channel_layer.receive(channel)
+            relay = message["relay"]
+
+            if message["type"] == "shard.open":
+                tunnel = self.tunnels[relay] = Tunnel(relay)
+                tunnel.queue.put_nowait({"type": "websocket.connect"})
+                asyncio.create_task(self.run(app, message["scope"], tunnel))
+
+            elif relay in self.tunnels:
+                self.tunnels[relay].queue.put_nowait(message["message"])
+
+    async def run(self, app, scope, tunnel):
+        try:
+            await app(scope, tunnel.receive, tunnel.send)
+        except Exception as e:
+            print("EXCEPTION -> Tunneled room consumer failed.")
+            print(e)
+        finally:
+            self.tunnels.pop(tunnel.relay, None)
+
+
+listener = ShardListener()
+
+
+class RoomShardRouter:
+    # Runs the room consumer when this worker owns the room, or the relay otherwise
+    def __init__(self, room_app, relay_app):
+        self.room_app = room_app
+        self.relay_app = relay_app
+        # The listener runs the same consumer for the relayed websockets
+        listener.app = room_app
+
+    async def __call__(self, scope, receive, send):
+        room_name = scope["url_route"]["kwargs"]["room_name"]
+
+        if is_local(room_name):
+            return await self.room_app(scope, receive, send)
+        return await self.relay_app(scope, receive, send)
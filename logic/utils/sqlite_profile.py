@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# SQLite pragmas for single node deployments (SQLITE_PROFILE), set on every new
+# connection. With the write-ahead log readers don't wait for the writer, so the
+# rooms read by the consumers aren't blocked by the write-behind updates.
+#  - "wal": write-ahead log, fsync only on checkpoints (synchronous=NORMAL, the last
+#    commits can be lost on a power failure but the database isn't corrupted), memory
+#    mapped reads, a larger page cache and waiting for locks instead of failing
+#  - "rollback": SQLite defaults (rollback journal, fsync on every commit)
+
+PROFILES = {
+    "wal": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        # 256 MB
+        "mmap_size": 256 * 1024 * 1024,
+        # Milliseconds
+        "busy_timeout": 5000,
+        # Negative is KB, 64 MB
+        "cache_size": -64 * 1024,
+    },
+    "rollback": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "mmap_size": 0,
+        "busy_timeout": 5000,
+        "cache_size": -2000,
+    },
+}
+
+
+def get_pragmas(profile=None):
+    if profile is None:
+        profile = getattr(settings, "SQLITE_PROFILE", "wal")
+    return PROFILES.get(profile, {})
+
+
+@receiver(connection_created)
+def apply_profile(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        for pragma, value in get_pragmas().items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
@@ -1,44 +1,94 @@
-from asgiref.sync import sync_to_async
+import json
+
+from django.db import transaction
+from django.db.models.expressions import RawSQL
+
 from ..models import RoomModel, WordsListModel
 from ..apps import import_current_word_list
+from . import room_persistence
+from .db_executor import executor
+
+
+# Database access of the websockets. Single queries use the async ORM, the rest (e.g.
+# transactions) runs in the DB executor, ordered with the other jobs of the same rooms.
 
 
-@sync_to_async
-def get_room(room_name):
-    room = RoomModel.objects.get(name=room_name)
-    return room
+async def get_room(room_name):
+    # Pending write-behind updates of the room must land before reading it
+    await room_persistence.flush(room_name)
+    return await RoomModel.objects.aget(name=room_name)
 
 
-@sync_to_async
-def print_get_all_rooms():
-    query = RoomModel.objects.all().values_list()
+async def print_get_all_rooms():
+    query = [room async for room in RoomModel.objects.all().values_list()]
     print(query)
 
 
-@sync_to_async
-def create_room(room_name):
+async def create_room(room_name, word_list="Current"):
     try:
-        room = RoomModel.objects.create(name=room_name)
+        await executor.wait(room_name)
+        room = await RoomModel.objects.acreate(name=room_name, word_list=word_list)
         return room
     except:
         return "Room with that name already created in the database"
 
 
-@sync_to_async
-def update_room(room):
-    return room.save()
+async def update_room(room):
+    return await room.asave()
+
+
+async def update_rooms_state(batch):
+    await executor.run([entry[0] for entry in batch], _update_rooms_state, batch)
+
+
+def _update_rooms_state(batch):
+    with transaction.atomic():
+        for room_name, fields, patch in batch:
+            if patch is not None and (patch[0] or patch[1]):
+                fields["current_connections"] = players_update(*patch)
+            if fields:
+                RoomModel.objects.filter(name=room_name).update(**fields)
+
+
+# Changed players replace their entries (by id) and new players are appended, in place
+PLAYERS_PATCH_SQL = """
+COALESCE((
+    SELECT jsonb_agg(COALESCE(%s::jsonb -> (player ->> 'id'), player) ORDER BY position)
+    FROM jsonb_array_elements(current_connections) WITH ORDINALITY AS t(player, position)
+), '[]'::jsonb) || %s::jsonb
+"""
+PLAYERS_APPEND_SQL = "COALESCE(current_connections, '[]'::jsonb) || %s::jsonb"
+
+
+def players_update(changed, joined):
+    # PostgreSQL JSONB expression for 'current_connections' (see 'room_persistence')
+    if not changed:
+        return RawSQL(PLAYERS_APPEND_SQL, (json.dumps(joined),))
+    return RawSQL(PLAYERS_PATCH_SQL, (json.dumps(changed), json.dumps(joined)))
+
+
+async def delete_room(room_name):
+    # After the updates of the room already in the executor
+    await executor.wait(room_name)
+    room = await RoomModel.objects.aget(name=room_name)
+    return await room.adelete()
+
+
+async def get_word_list(name="Current"):
+    return await WordsListModel.objects.aget(name=name)
 
 
-@sync_to_async
-def delete_room(room_name):
-    return RoomModel.objects.get(name=room_name).delete()
+async def get_word_list_updated_at(name="Current"):
+    return (
+        await WordsListModel.objects.filter(name=name)
+        .values_list("updated_at", flat=True)
+        .afirst()
+    )
 
 
-@sync_to_async
-def get_word_list():
-    return WordsListModel.objects.get(name="Current")
+async def create_word_list(name, word_list):
+    return await WordsListModel.objects.acreate(name=name, word_list=word_list)
 
 
-@sync_to_async
-def set_word_list():
-    import_current_word_list()
+async def set_word_list():
+    await executor.run((), import_current_word_list)
@@ -0,0 +1,46 @@
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import room_state, voting, wire
+from .deadlines import scheduler
+
+
+# Turn deadlines. A player that doesn't give its word in TURN_TIMEOUT seconds (or leaves
+# the room) loses the turn, and the voting starts when the last player of the round is
+# done.
+
+
+def start_turn(room, player):
+    if player is None:
+        # Every player has played, the room votes now
+        scheduler.cancel(room.name, "turn")
+        if room.voting is None:
+            voting.open_voting(room)
+        return
+
+    scheduler.schedule(
+        room.name,
+        "turn",
+        getattr(settings, "TURN_TIMEOUT", 45),
+        lambda: pass_turn(room, player),
+    )
+
+
+async def pass_turn(room, player):
+    # The turn could have ended (or the room been deleted) meanwhile
+    if room_state.rooms.get(room.name) is not room or room.current_turn() is not player:
+        return
+
+    next_player = room.next_turn(player)
+    await room_state.save_room(room)
+    start_turn(room, next_player)
+
+    await get_channel_layer().group_send(
+        room.group_name,
+        {
+            "type": "nextTurn",
+            "message": {"next_player": next_player.id if next_player else ""},
+            "username": player.username,
+            **wire.roster_event(room),
+        },
+    )
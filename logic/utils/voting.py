@@ -0,0 +1,116 @@
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .consumer_classes import State
+from . import room_state, wire
+from .deadlines import scheduler
+
+
+# Per-room vote aggregator. Ballots are counted incrementally when received and
+# only the result is broadcast to the room group ('votingComplete').
+
+
+class VoteTally:
+    def __init__(self, voters):
+        self.voters = set(voters)
+        self.ballots = {}
+        self.counts = {}
+        self.leader = ""
+        self.leader_votes = 0
+        self.tie = False
+
+    def cast(self, voter_id, player_id):
+        if voter_id not in self.voters or voter_id in self.ballots:
+            return False
+
+        self.ballots[voter_id] = player_id
+        votes = self.counts.get(player_id, 0) + 1
+        self.counts[player_id] = votes
+
+        # Counts only grow, so the leader can be kept without sorting
+        if votes > self.leader_votes:
+            self.leader = player_id
+            self.leader_votes = votes
+            self.tie = False
+        elif votes == self.leader_votes:
+            self.tie = True
+
+        return True
+
+    def remove_voter(self, voter_id):
+        self.voters.discard(voter_id)
+
+    @property
+    def complete(self):
+        return len(self.ballots) >= len(self.voters)
+
+    def result(self):
+        # Nobody is out if there's no most voted player
+        return "" if self.tie else self.leader
+
+
+def open_voting(room):
+    voters = [
+        player.id
+        for player in room.current_connections
+        if player.state == State.PLAYER_TURN or player.state == State.PLAYING
+    ]
+    tally = VoteTally(voters)
+
+    # Missing ballots don't hold the room
+    scheduler.schedule(
+        room.name,
+        "voting",
+        getattr(settings, "VOTING_TIMEOUT", 60),
+        lambda: close_voting(room, tally),
+    )
+
+    room.voting = tally
+    return tally
+
+
+def cancel_voting(room):
+    if room.voting:
+        scheduler.cancel(room.name, "voting")
+    room.voting = None
+
+
+async def cast_vote(room, voter_id, player_id):
+    tally = room.voting or open_voting(room)
+
+    if tally.cast(voter_id, player_id) and tally.complete:
+        await close_voting(room, tally)
+
+
+async def remove_voter(room, voter_id):
+    tally = room.voting
+    if not tally:
+        return
+
+    tally.remove_voter(voter_id)
+    if tally.ballots and tally.complete:
+        await close_voting(room, tally)
+
+
+async def close_voting(room, tally):
+    # The deadline could expire after the voting was already closed
+    if room.voting is not tally:
+        return
+    cancel_voting(room)
+
+    player_out, next_captain, can_continue = await room_state.eliminate_player(
+        room, tally.result()
+    )
+    await room_state.save_room(room)
+
+    await get_channel_layer().group_send(
+        room.group_name,
+        {
+            "type": "votingComplete",
+            "player_out": player_out.to_dict() if player_out else "",
+            "continue_playing": can_continue,
+            "number_outsiders": room.number_outsiders,
+            "next_captain": next_captain.to_dict() if next_captain else None,
+            **wire.roster_event(room),
+        },
+    )
@@ -0,0 +1,127 @@
+import json
+
+import msgpack
+
+
+# Messages sent to the clients. The roster ('actual_users') and the user are sent as JSON
+# strings inside the message, so the sender encodes them once for every recipient of the
+# room group and each consumer only adds its own fields to the prepared frame.
+#
+# Clients negotiating the BINARY_SUBPROTOCOL get the same messages as MessagePack binary
+# frames, with the roster and the user as nested maps and arrays instead of strings.
+# MessagePack values can be concatenated, so those frames are also put together from
+# parts encoded once (every player keeps its packed roster entry, see 'to_packed').
+
+BINARY_SUBPROTOCOL = "outsider.msgpack.v1"
+
+packer = msgpack.Packer()
+
+
+def encode(value):
+    return json.dumps(value, default=lambda x: x.to_dict())
+
+
+def encode_nested(value):
+    return json.dumps(encode(value))
+
+
+def roster_array(players):
+    # Every player keeps its own encoding until it changes
+    return "[" + ", ".join(player.to_wire() for player in players) + "]"
+
+
+def encode_roster(players):
+    return json.dumps(roster_array(players))
+
+
+def encode_delta(ops):
+    parts = []
+    for op, value in ops:
+        if op == "join" or op == "update":
+            parts.append(f'{{"op": "{op}", "player": {value.to_wire()}}}')
+        elif op == "leave":
+            parts.append(f'{{"op": "leave", "id": {json.dumps(value)}}}')
+        else:
+            parts.append(f'{{"op": "order", "ids": {json.dumps(value)}}}')
+    return "[" + ", ".join(parts) + "]"
+
+
+def roster_event(room):
+    # Room group fields for both kinds of clients: the whole roster (nested, for the
+    # current clients) and the changes since the previous roster message ('delta' clients)
+    seq, ops = room.roster_delta()
+    event = {
+        "actual_users": encode_roster(room.current_connections),
+        "roster_seq": seq,
+        "roster_delta": encode_delta(ops),
+    }
+    if room.binary_clients:
+        event.update(packed_roster_event(room, ops))
+    return event
+
+
+def frame(content, prepared=None):
+    parts = [
+        f"{json.dumps(key)}: {json.dumps(value)}" for key, value in content.items()
+    ]
+
+    if prepared:
+        parts += [f"{json.dumps(key)}: {value}" for key, value in prepared.items()]
+
+    return "{" + ", ".join(parts) + "}"
+
+
+# region MessagePack
+
+
+def pack(value):
+    return msgpack.packb(value, default=lambda x: x.to_dict())
+
+
+def unpack(data):
+    return msgpack.unpackb(data)
+
+
+def packed_array(parts):
+    return packer.pack_array_header(len(parts)) + b"".join(parts)
+
+
+def packed_map(items):
+    # (key, packed value) pairs
+    return packer.pack_map_header(len(items)) + b"".join(
+        pack(key) + value for key, value in items
+    )
+
+
+def packed_roster(players):
+    return packed_array([player.to_packed() for player in players])
+
+
+def packed_delta(ops):
+    parts = []
+    for op, value in ops:
+        if op == "join" or op == "update":
+            parts.append(packed_map([("op", pack(op)), ("player", value.to_packed())]))
+        elif op == "leave":
+            parts.append(packed_map([("op", pack(op)), ("id", pack(value))]))
+        else:
+            parts.append(packed_map([("op", pack(op)), ("ids", pack(value))]))
+    return packed_array(parts)
+
+
+def packed_roster_event(room, ops):
+    # Only for the rooms with binary clients (see 'roster_event')
+    return {
+        "packed_users": packed_roster(room.current_connections),
+        "packed_delta": packed_delta(ops),
+    }
+
+
+def packed_frame(content, prepared=None):
+    items = [(key, pack(value)) for key, value in content.items()]
+    if prepared:
+        items += list(prepared.items())
+    return packed_map(items)
+
+
+# endregion
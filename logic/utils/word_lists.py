@@ -0,0 +1,105 @@
+import random
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from ..models import WordsListModel
+from . import sync_rest_calls
+
+
+# Process-wide cache of the word lists. Lists are loaded on first use into a bounded
+# LRU cache and invalidated when a list is saved or deleted (e.g. from the admin). The
+# other processes (workers) find out on their next use: only the modification time of
+# the list is read to check it, the words are loaded again when it changed.
+
+
+class WordList:
+    def __init__(self, name, words, updated_at=None):
+        self.name = name
+        self.words = words
+        self.updated_at = updated_at
+        self._index = None
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def index(self):
+        # Position of every word, only needed to restore a room's used words
+        if self._index is None:
+            self._index = {
+                (word["a"], word["b"]): i for i, word in enumerate(self.words)
+            }
+        return self._index
+
+
+class WordBag:
+    # Lazy Fisher-Yates shuffle: every draw is O(1) and only the swapped positions are
+    # stored, so the word list is never copied or filtered
+    def __init__(self, word_list, used=()):
+        self.word_list = word_list
+        self.drawn = 0
+        self.swaps = {}
+        self.excluded = set()
+
+        for word in used:
+            i = word_list.index.get((word["a"], word["b"]))
+            if i is not None:
+                self.excluded.add(i)
+
+    def draw(self):
+        words = self.word_list.words
+        size = len(words)
+
+        while self.drawn < size:
+            j = random.randrange(self.drawn, size)
+            selected = self.swaps.get(j, j)
+            current = self.swaps.pop(self.drawn, self.drawn)
+            if j != self.drawn:
+                self.swaps[j] = current
+            self.drawn += 1
+
+            if selected in self.excluded:
+                self.excluded.discard(selected)
+                continue
+
+            return words[selected]
+
+        return None
+
+
+word_lists = OrderedDict()
+
+
+async def get_word_list(name="Current"):
+    word_list = word_lists.get(name)
+    if word_list is not None:
+        updated_at = await sync_rest_calls.get_word_list_updated_at(name=name)
+        if updated_at != word_list.updated_at:
+            invalidate(name)
+            word_list = None
+
+    if word_list is None:
+        db_list = await sync_rest_calls.get_word_list(name=name)
+        word_list = word_lists.setdefault(
+            name, WordList(name, db_list.word_list, db_list.updated_at)
+        )
+
+    word_lists.move_to_end(name)
+    while len(word_lists) > getattr(settings, "WORD_LISTS_CACHE_SIZE", 8):
+        word_lists.popitem(last=False)
+
+    return word_list
+
+
+def invalidate(name):
+    word_lists.pop(name, None)
+
+
+@receiver(post_save, sender=WordsListModel)
+@receiver(post_delete, sender=WordsListModel)
+def invalidate_word_list(sender, instance, **kwargs):
+    invalidate(instance.name)
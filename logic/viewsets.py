@@ -33,8 +33,23 @@ class RoomViewSet(GenericViewSet, RetrieveModelMixin, DestroyModelMixin):
                 status.HTTP_302_FOUND,
             )
 
+        # Word list used in the room, by name (language, theme...)
+        word_list = request.data.get("word_list", "Current")
+
+        if not isinstance(word_list, str):
+            return Response(
+                "Wrong request (the word list is a name)",
+                status.HTTP_400_BAD_REQUEST,
+            )
+
+        if not WordsListModel.objects.filter(name=word_list).exists():
+            return Response(
+                "Word list: '" + word_list + "' does not exist",
+                status.HTTP_400_BAD_REQUEST,
+            )
+
         # Create the room with the given name
-        created_room = RoomModel.objects.create(name=room_name)
+        created_room = RoomModel.objects.create(name=room_name, word_list=word_list)
 
         serializer = RoomSerializer(instance=created_room, context={"request": request})
         return Response(serializer.data, status.HTTP_200_OK)
@@ -43,7 +58,7 @@ class RoomViewSet(GenericViewSet, RetrieveModelMixin, DestroyModelMixin):
 class RoomSerializer(serializers.ModelSerializer):
     class Meta:
         model = RoomModel
-        fields = ["id", "name", "started_game"]
+        fields = ["id", "name", "started_game", "word_list"]
 
 
 class WordListViewSet(GenericViewSet, RetrieveModelMixin):
@@ -0,0 +1,215 @@
+"""
+Production server for 'outsider'.
+
+    python -m outsider.server --host 0.0.0.0 --port 8050 --workers 4
+
+Runs 'outsider.asgi.application' with Daphne in a pool of worker processes sharing
+one listening socket. Every worker owns a shard of the rooms (see
+'logic.utils.sharding'), so more than one worker needs the Redis channel layer.
+
+On SIGTERM (or SIGINT) the workers stop accepting connections, keep serving their
+active rooms for up to '--grace' seconds and write their pending room updates before
+exiting. Websocket frames are compressed (permessage-deflate) for the clients offering
+it, see 'logic.utils.deflate'. Migrations are not run here, prepare the database once per deploy with
+'python manage.py migrate' and 'python manage.py bootstrap'.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m outsider.server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1))
+    )
+    parser.add_argument(
+        "--grace",
+        type=float,
+        default=None,
+        help="Seconds to wait for the active rooms on shutdown (SHUTDOWN_GRACE)",
+    )
+    # Internal, used by the supervisor to start every worker
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--fd", type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# region Supervisor
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}
+        self.started = {}
+        self.stopping = False
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.args.host, self.args.port))
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, shard):
+        env = dict(os.environ)
+        env.setdefault("DJANGO_SETTINGS_MODULE", "outsider.settings")
+        env["ROOM_SHARDS"] = str(self.args.workers)
+        env["ROOM_SHARD"] = str(shard)
+
+        command = [
+            sys.executable,
+            "-m",
+            "outsider.server",
+            "--worker",
+            str(shard),
+            "--fd",
+            str(self.sock.fileno()),
+        ]
+        if self.args.grace is not None:
+            command += ["--grace", str(self.args.grace)]
+
+        self.workers[shard] = subprocess.Popen(
+            command, env=env, pass_fds=[self.sock.fileno()]
+        )
+        self.started[shard] = time.monotonic()
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            # Second signal, don't wait for the active rooms
+            for process in self.workers.values():
+                process.kill()
+            return
+
+        print("Stopping workers...")
+        self.stopping = True
+        # The port is closed once every worker stops listening too
+        self.sock.close()
+        for process in self.workers.values():
+            process.send_signal(signal.SIGTERM)
+
+    def run(self):
+        self.sock = self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        print(
+            f"Listening on {self.args.host}:{self.args.port} "
+            f"with {self.args.workers} workers"
+        )
+        for shard in range(self.args.workers):
+            self.spawn(shard)
+
+        while self.workers:
+            for shard, process in list(self.workers.items()):
+                if process.poll() is None:
+                    continue
+
+                del self.workers[shard]
+                if self.stopping:
+                    continue
+
+                print(f"Worker {shard} exited with code {process.returncode}")
+                if time.monotonic() - self.started[shard] < 5:
+                    # Failed on startup, restarting it would fail again
+                    self.stop(signal.SIGTERM, None)
+                else:
+                    # Restart the worker, its shard of rooms has no other owner
+                    self.spawn(shard)
+            time.sleep(0.5)
+
+
+# endregion
+
+# region Worker
+
+
+def run_worker(args):
+    # Daphne installs the asyncio Twisted reactor, it must be imported first
+    from daphne.server import Server
+
+    import asyncio
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "outsider.settings")
+    django.setup()
+
+    from django.conf import settings
+    from twisted.internet import defer, reactor
+
+    from logic.utils import deflate, lifecycle
+    from outsider.asgi import application
+
+    class WorkerServer(Server):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ports = []
+
+        def listen_success(self, port):
+            self.ports.append(port)
+            return super().listen_success(port)
+
+        def drain(self, grace):
+            if lifecycle.draining:
+                return
+
+            print(f"Worker {args.worker} draining...")
+            for port in self.ports:
+                port.stopListening()
+
+            drained = defer.Deferred.fromFuture(
+                asyncio.ensure_future(lifecycle.drain(grace))
+            )
+            drained.addBoth(lambda _: self.stop())
+
+    server = WorkerServer(
+        application=application,
+        endpoints=[f"fd:fileno={args.fd}"],
+        # Protocol pings for the clients without the application heartbeat
+        ping_interval=settings.HEARTBEAT_INTERVAL,
+        ping_timeout=settings.HEARTBEAT_GRACE,
+        # SIGTERM drains the worker instead of stopping the reactor
+        signal_handlers=False,
+    )
+
+    def install_signal_handlers():
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, server.drain, args.grace)
+        # The supervisor forwards Ctrl+C as SIGTERM
+        loop.add_signal_handler(signal.SIGINT, lambda: None)
+
+    def warmup():
+        asyncio.ensure_future(lifecycle.warmup())
+
+    def configure_websockets():
+        # The factory is created by 'run', before the first connection is accepted
+        deflate.configure(server.ws_factory)
+
+    reactor.callWhenRunning(configure_websockets)
+    reactor.callWhenRunning(install_signal_handlers)
+    reactor.callWhenRunning(warmup)
+    server.run()
+
+
+# endregion
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker is None:
+        Supervisor(args).run()
+    else:
+        run_worker(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = "django-insecure-t!tf*ix*7aa)yaa-m8379yo%u**)rn!*c3m+g4l7s9#!)h1ao&"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.environ.get("DJANGO_DEBUG", "True") == "True"
 
 # To run the app in local set DEBUG to True and change the url values in OutsiderProject\outsider-front\src\constants.js
 
@@ -88,31 +88,135 @@ WSGI_APPLICATION = "outsider.wsgi.application"
 # ASGI and Channels Configuration
 ASGI_APPLICATION = "outsider.asgi.application"
 
-# To test the websocket backend via 'pytest', the TEST flag must be set to false and a valid redis server must be running on localhost
-TEST = False
-if TEST == True:
-    redis_hosts = [("localhost", 6379), ("0.0.0.0", 6379)]
+# Channel layer, chosen with the CHANNEL_LAYER environment variable:
+#  - "hybrid": Redis (REDIS_HOSTS, comma separated), but the channels and groups of each
+#    process are reached without it. Rooms are always played by one process (see
+#    'logic.utils.sharding'), so their groups never use Redis
+#  - "redis": plain Redis channel layer
+#  - "local": single process without Redis (e.g. one worker or running the tests)
+CHANNEL_LAYER = os.environ.get("CHANNEL_LAYER", "hybrid")
+REDIS_HOSTS = os.environ.get("REDIS_HOSTS", "redis://redis:6379").split(",")
+
+if CHANNEL_LAYER == "redis":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_HOSTS,
+                # Websockets tunneled to the worker owning their room
+                "channel_capacity": {"room-shard.*": 10000},
+            },
+        },
+    }
 else:
-    redis_hosts = [("redis", 6379)]
-
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": redis_hosts,
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "logic.utils.channel_layer.HybridChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_HOSTS if CHANNEL_LAYER == "hybrid" else [],
+                "local_groups": ["room_"],
+                # Websockets tunneled to the worker owning their room
+                "channel_capacity": {"room-shard.*": 10000},
+            },
         },
-    },
-}
+    }
+
+# Rooms are split between ROOM_SHARDS worker processes by the hash of their name, each
+# worker must run with its own ROOM_SHARD (0 ... ROOM_SHARDS - 1). A websocket accepted by
+# another worker is relayed to the room owner through the channel layer, so routing the
+# room path to its owner in the proxy saves that hop
+ROOM_SHARDS = int(os.environ.get("ROOM_SHARDS", 1))
+ROOM_SHARD = int(os.environ.get("ROOM_SHARD", 0))
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# Chosen with the DATABASE environment variable:
+#  - "sqlite": the local 'db.sqlite3' file (a single writer at a time)
+#  - "postgresql": the POSTGRES_* server. Each thread using the database (see
+#    'logic.utils.db_executor') keeps its connection open for CONN_MAX_AGE seconds
+#    instead of connecting on every query, put PgBouncer in front to share them
+#    between workers. Room updates only write the players that changed (JSONB)
+DATABASE = os.environ.get("DATABASE", "sqlite")
+
+if DATABASE == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("POSTGRES_DB", "outsider"),
+            "USER": os.environ.get("POSTGRES_USER", "postgres"),
+            "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+            "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
+            "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+            "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", 600)),
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+        }
     }
-}
+
+# SQLite pragmas set on every connection (see 'logic.utils.sqlite_profile'): "wal" (readers
+# don't wait for the writer) or "rollback" (SQLite defaults)
+SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "wal")
+
+# Rooms state is written behind: updates of the same room inside the window (seconds) are
+# coalesced into a single UPDATE. A window of 0 writes every update before continuing
+ROOM_PERSISTENCE_WINDOW = 0.05
+ROOM_PERSISTENCE_BATCH_SIZE = 100
+
+# Threads running the database work without an async API (see 'logic.utils.db_executor')
+# and maximum number of jobs queued or running before the callers wait
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", 4))
+DB_EXECUTOR_QUEUE = 1000
+
+# Shared state of the active rooms, chosen with the ROOM_STORE environment variable:
+#  - "database": written behind to the rooms table (above)
+#  - "redis": one hash per room in the first of REDIS_HOSTS, changed with atomic scripts
+#    (see 'logic.utils.room_store'). The rooms table only records which rooms exist
+ROOM_STORE = os.environ.get("ROOM_STORE", "database")
+# Seconds an untouched room is kept in Redis (e.g. rooms of a crashed worker)
+ROOM_STORE_TTL = 24 * 60 * 60
+
+# The worker playing a room renews its lease every ROOM_LEASE_RENEW seconds, rooms whose
+# lease expired (ROOM_LEASE_TTL seconds, e.g. their worker crashed) are deleted by any
+# worker in batches of ROOM_REAPER_BATCH (see 'logic.utils.leases')
+ROOM_LEASE_TTL = 60
+ROOM_LEASE_RENEW = 15
+ROOM_REAPER_BATCH = 100
+
+# Seconds a player has to give its word, then the turn passes to the next player
+TURN_TIMEOUT = 45
+
+# Seconds to wait for every ballot since the voting starts (the last turn of the round or
+# the first vote)
+VOTING_TIMEOUT = 60
+
+# Room websockets are pinged after HEARTBEAT_INTERVAL seconds without messages and closed
+# if they don't answer within HEARTBEAT_GRACE seconds (see 'logic.utils.heartbeat'). The
+# idle sockets are checked every HEARTBEAT_TICK seconds
+HEARTBEAT_INTERVAL = 20
+HEARTBEAT_GRACE = 10
+HEARTBEAT_TICK = 1
+
+# Websocket compression (permessage-deflate) of the production server (see
+# 'logic.utils.deflate'): frames shorter than WEBSOCKET_DEFLATE_THRESHOLD bytes are sent
+# uncompressed, and WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER keeps the compression window of each
+# connection between messages (smaller roster messages, more memory per connection)
+WEBSOCKET_DEFLATE = os.environ.get("WEBSOCKET_DEFLATE", "True") == "True"
+WEBSOCKET_DEFLATE_THRESHOLD = 256
+WEBSOCKET_DEFLATE_CONTEXT_TAKEOVER = True
+
+# Seconds a stopping worker keeps serving its active rooms before writing them and exiting
+SHUTDOWN_GRACE = int(os.environ.get("SHUTDOWN_GRACE", 30))
+
+# Maximum number of word lists kept in memory by each process (least recently used are dropped,
+# lists changed by any process are loaded again on their next use)
+WORD_LISTS_CACHE_SIZE = 8
 
 
 # Password validation